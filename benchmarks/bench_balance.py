@@ -0,0 +1,323 @@
+# minqlbot - A Quake Live server administrator bot.
+# Copyright (C) 2015 Mino <mino@minomino.org>
+
+# This file is part of minqlbot.
+
+# minqlbot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# minqlbot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with minqlbot. If not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmark the balance plugin on generated lobbies, without a Quake Live server.
+
+A stub minqlbot module stands in for the real one, keeping the teams in memory and
+counting the switches and puts the plugin issues. Run it from the repository's root:
+
+    python benchmarks/bench_balance.py --lobbies 50 --sizes 1-16
+
+For every team size and rating distribution it reports, for each mode, the latency
+percentiles, the average number of commands issued and the average difference in
+rating between the teams afterwards. Every mode starts from the same lineups. The modes are:
+
+    stepwise     the greedy swaps, one switch each, like !balance did before plan_moves()
+    greedy       !balance with Algorithm: greedy
+    optimal      !balance with Algorithm: optimal
+    suggestion   !teams followed by doing the single switch it suggests, if any
+    switch       suggest_switch() followed by doing the switch it returns, if any
+    average      team_average() on both teams, just to time it
+
+Afterwards, the average number of commands of the stepwise, greedy and optimal modes are
+listed side by side, to show what plan_moves() saves.
+
+"""
+
+import argparse
+import configparser
+import os
+import random
+import re
+import sqlite3
+import statistics
+import sys
+import time
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+DISTRIBUTIONS = {
+    "normal": lambda rng: rng.gauss(1500, 300),
+    "uniform": lambda rng: rng.uniform(800, 2400),
+    "bimodal": lambda rng: rng.gauss(1100, 150) if rng.random() < 0.5 else rng.gauss(1900, 150),
+    "skewed": lambda rng: 800 + rng.lognormvariate(6, 0.6),
+}
+MODES = ("stepwise", "greedy", "optimal", "suggestion", "switch", "average")
+# The modes that do a full balance, for comparing how many commands they need.
+BALANCE_MODES = ("stepwise", "greedy", "optimal")
+
+class Channel():
+    def reply(self, msg):
+        pass
+
+class Player():
+    def __init__(self, server, name, team):
+        self.server = server
+        self.name = name
+        self.clean_name = name
+        self.team = team
+
+    def __str__(self):
+        return self.name
+
+    def put(self, team):
+        self.server.move(self, team)
+
+    def tell(self, msg):
+        pass
+
+    def mute(self):
+        pass
+
+    def kickban(self):
+        pass
+
+class Game():
+    short_type = "ca"
+    type = "Clan Arena"
+    # Not warmup, so the plugin doesn't start precomputing anything in the background.
+    state = "in_progress"
+    map = "campgrounds"
+    red_score = 0
+    blue_score = 0
+
+class Server():
+    """The teams, and how many commands the plugin has issued to change them."""
+    def __init__(self):
+        self.players = []
+        self.game = Game()
+        self.commands = 0
+
+    def teams(self):
+        teams = {"red": [], "blue": [], "spectator": [], "free": []}
+        for player in self.players:
+            teams[player.team].append(player)
+        return teams
+
+    def move(self, player, team):
+        import plugins.teamstate as teamstate
+        player.team = team
+        # The real server would send a team_switch, which is what keeps the tracker up to date.
+        teamstate.tracker.switch(player, team)
+
+def make_minqlbot(server, config):
+    """Make a module that does just enough of what minqlbot does for the balance plugin."""
+    minqlbot = types.ModuleType("minqlbot")
+    minqlbot.PRI_HIGHEST, minqlbot.PRI_HIGH, minqlbot.PRI_NORMAL, minqlbot.PRI_LOW, minqlbot.PRI_LOWEST = range(5)
+    minqlbot.RET_NONE, minqlbot.RET_STOP, minqlbot.RET_USAGE = range(3)
+    minqlbot.NAME = "bench"
+    minqlbot.CHAT_CHANNEL = Channel()
+    minqlbot.get_config = lambda: config
+    minqlbot.debug = lambda msg: None
+    db = sqlite3.connect(":memory:", check_same_thread=False)
+    db.row_factory = sqlite3.Row
+
+    class Plugin():
+        plugins = {}
+
+        def __init__(self):
+            Plugin.plugins[self.__class__.__name__] = self
+
+        def add_hook(self, *args, **kwargs):
+            pass
+
+        def add_command(self, *args, **kwargs):
+            pass
+
+        def teams(self):
+            return server.teams()
+
+        def game(self):
+            return server.game
+
+        def players(self):
+            return list(server.players)
+
+        def player(self, name):
+            for player in server.players:
+                if player.clean_name.lower() == name.lower():
+                    return player
+
+        def msg(self, msg, channel="chat"):
+            pass
+
+        def tell(self, msg, name):
+            pass
+
+        def put(self, player, team):
+            if isinstance(player, str):
+                player = self.player(player)
+            server.commands += 1
+            server.move(player, team)
+
+        def switch(self, one, other):
+            server.commands += 1
+            one_team, other_team = one.team, other.team
+            server.move(one, other_team)
+            server.move(other, one_team)
+
+        def lock(self, team=None):
+            pass
+
+        def unlock(self, team=None):
+            pass
+
+        def delay(self, secs, func, args=(), kwargs={}):
+            raise RuntimeError("Nothing should be delayed during the benchmark.")
+
+        def debug(self, msg):
+            pass
+
+        def clean_text(self, text):
+            return re.sub(r"\^[0-9]", "", text)
+
+        def db_query(self, query, *args):
+            return db.execute(query, args)
+
+        def db_querymany(self, query, *args):
+            return db.executemany(query, args)
+
+        def db_commit(self):
+            db.commit()
+
+        def db_close(self):
+            pass
+
+    minqlbot.Plugin = Plugin
+    return minqlbot
+
+def make_config(args):
+    config = configparser.ConfigParser()
+    config["Balance"] = {"UseLocalRatings": "False", "UseGlickoRatings": "False", "PrecomputeTeams": "False",
+                         "AutoBalance": "False", "Algorithm": "greedy", "OptimalTimeBudget": str(args.budget),
+                         "MinimumSuggestionDifference": str(args.min_diff), "FloorRating": "0",
+                         "CeilingRating": "0", "CacheSize": "100000"}
+    return config
+
+def parse_sizes(s):
+    if "-" in s:
+        start, stop = s.split("-")
+        return list(range(int(start), int(stop) + 1))
+    return [int(x) for x in s.split(",")]
+
+def stepwise_balance(bot, game_type):
+    """Apply the greedy swaps one at a time with a switch each, without plan_moves().
+    The teams are always the same size here, so nobody has to be put anywhere.
+
+    """
+    import plugins.teambalance as teambalance
+    import plugins.teamstate as teamstate
+    teams = teamstate.tracker.teams(bot)
+    red = teams["red"]
+    blue = teams["blue"]
+    evaluator = teambalance.SwapEvaluator(bot.team_ratings(red, game_type), bot.team_ratings(blue, game_type))
+    swap = evaluator.best_swap()
+    while swap:
+        i, j = swap[0], swap[1]
+        bot.switch(red[i], blue[j])
+        red[i], blue[j] = blue[j], red[i]
+        evaluator.swap(i, j)
+        swap = evaluator.best_swap()
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(p / 100 * len(values)), len(values) - 1)]
+
+def run(args):
+    server = Server()
+    config = make_config(args)
+    sys.modules["minqlbot"] = make_minqlbot(server, config)
+    import plugins.balance as balance
+    import plugins.teamstate as teamstate
+
+    bot = balance.balance()
+    channel = Channel()
+    rng = random.Random(args.seed)
+    lobby = 0
+    # Items: (size, distribution, {mode: average commands})
+    summary = []
+
+    print("{:>5} {:>8} {:>10} {:>9} {:>9} {:>9} {:>9} {:>9}"
+          .format("size", "ratings", "mode", "p50_ms", "p90_ms", "p99_ms", "commands", "diff"))
+    for size in args.sizes:
+        for distribution, generate in DISTRIBUTIONS.items():
+            results = {mode: ([], [], []) for mode in MODES}
+            for i in range(args.lobbies):
+                lobby += 1
+                ratings = [max(int(generate(rng)), 1) for j in range(2 * size)]
+                names = ["l{}p{}".format(lobby, j) for j in range(2 * size)]
+                bot.cache_players({"players": [{"nick": n, "ca": {"elo": r, "rank": 1}} for n, r in zip(names, ratings)]}, None)
+                rng.shuffle(names)
+
+                for mode in MODES:
+                    server.players = [Player(server, n, "red" if j < size else "blue") for j, n in enumerate(names)]
+                    teamstate.tracker.sync(server.teams())
+                    server.commands = 0
+                    config["Balance"]["Algorithm"] = mode if mode in ("greedy", "optimal") else "greedy"
+
+                    start = time.perf_counter()
+                    if mode == "stepwise":
+                        stepwise_balance(bot, "ca")
+                    elif mode == "suggestion":
+                        bot.teams_info(channel, "ca")
+                        if bot.suggested_pair:
+                            bot.execute_suggestion()
+                    elif mode == "switch":
+                        switch = bot.suggest_switch(teamstate.tracker.teams(bot), "ca")
+                        if switch:
+                            bot.switch(*switch[0])
+                    elif mode == "average":
+                        teams = teamstate.tracker.teams(bot)
+                        bot.team_average(teams["red"], "ca")
+                        bot.team_average(teams["blue"], "ca")
+                    else:
+                        bot.average_balance(channel, "ca")
+                    elapsed = time.perf_counter() - start
+
+                    teams = server.teams()
+                    diff = abs(bot.team_average(teams["red"], "ca") - bot.team_average(teams["blue"], "ca"))
+                    results[mode][0].append(elapsed * 1000)
+                    results[mode][1].append(server.commands)
+                    results[mode][2].append(diff)
+
+            for mode in MODES:
+                times, commands, diffs = results[mode]
+                print("{:>5} {:>8} {:>10} {:>9.3f} {:>9.3f} {:>9.3f} {:>9.2f} {:>9.1f}"
+                      .format("{0}v{0}".format(size), distribution, mode, percentile(times, 50), percentile(times, 90),
+                              percentile(times, 99), statistics.mean(commands), statistics.mean(diffs)))
+            summary.append((size, distribution, {mode: statistics.mean(results[mode][1]) for mode in BALANCE_MODES}))
+
+    print()
+    print("{:>5} {:>8}".format("size", "ratings") + "".join(" {:>9}".format(mode) for mode in BALANCE_MODES))
+    for size, distribution, commands in summary:
+        print("{:>5} {:>8}".format("{0}v{0}".format(size), distribution) +
+              "".join(" {:>9.2f}".format(commands[mode]) for mode in BALANCE_MODES))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the balance plugin on generated lobbies.")
+    parser.add_argument("--lobbies", type=int, default=50, help="lobbies per team size and rating distribution")
+    parser.add_argument("--sizes", type=parse_sizes, default=list(range(1, 17)),
+                        help="team sizes, like 1-16 or 4,8")
+    parser.add_argument("--seed", type=int, default=0, help="seed for generating the lobbies")
+    parser.add_argument("--budget", type=int, default=5, help="OptimalTimeBudget in milliseconds")
+    parser.add_argument("--min-diff", type=int, default=25, help="MinimumSuggestionDifference")
+    run(parser.parse_args(argv))
+
+if __name__ == "__main__":
+    main()
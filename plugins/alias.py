@@ -83,10 +83,5 @@ class alias(minqlbot.Plugin):
 
     def remove_name_from_balance_cache(self, name):
         if "balance" in self.plugins:
-            self.debug(name)
-            self.debug([key for key in self.plugins["balance"].cache])
-            if name in self.plugins["balance"].cache:
-                with self.plugins["balance"].lock: # Gotta use the lock!
-                    self.debug("Removed {} from balance's rating cache!".format(name))
-                    del self.plugins["balance"].cache[name]
-    
\ No newline at end of file
+            if self.plugins["balance"].remove_cached(name):
+                self.debug("Removed {} from balance's rating cache!".format(name))
@@ -31,37 +31,58 @@ aliases into account by fetching the ratings from the real names instead when us
 All this combined inevitably makes the code somewhat complex.
 
 When !teams or !balance is called, the plugin will check if we have all the players
-cached. If they are, just go ahead and execute the commands. If not, we'll add an entry
-to a list of pending actions (the !teams or !balance), and call the function to fetch the
-ratings of the players we don't have cached. This function will first check any manually
-assigned ratings if the config is set to. If we still don't have what we need, we start a
-thread and let it fetch ratings from QLRanks, taking into account aliases if set to do so
-in the config. The thread will then make sure the players are cached and finally execute
-pending tasks. To avoid accessing a shared resource on multiple threads, we use a re-entrant
-lock. This makes it safe to add additional tasks, such as alternative shuffling algorithms
-and whatnot without having to deal with that.
+cached. If they are, just go ahead and execute the commands. If not, we'll call the
+function to fetch the ratings of the players we don't have cached, and have the action
+(the !teams or !balance) run once the lookups of those particular players are done. This
+function will first check any manually assigned ratings if the config is set to, then
+ratings from earlier QLRanks lookups that we've saved in the database. If we still don't
+have what we need, we start a thread and let it fetch ratings from QLRanks, taking into
+account aliases if set to do so in the config. The thread will then make sure the
+players are cached and finally let whoever is waiting for those players know. To avoid
+accessing a shared resource on multiple threads, we use a re-entrant lock. This makes it
+safe to add additional tasks, such as alternative shuffling algorithms and whatnot
+without having to deal with that.
 """
 
 from threading import RLock
+import concurrent.futures
+import plugins.glicko as glicko
 import plugins.qlranks as qlranks
+import plugins.ratingcache as ratingcache
+import plugins.ratingsketch as ratingsketch
+import plugins.teambalance as teambalance
+import plugins.teamstate as teamstate
 import minqlbot
 import random
 import re
 import threading
 import datetime
 
-FAILS_ALLOWED = 2
 QLRANKS_GAMETYPES = ("ca", "ffa", "ctf", "duel", "tdm")
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+# How long the nick part of a QLRanks request can get before it's split into several requests.
+MAX_NICKS_LENGTH = 1000
+# The least amount of seconds to keep expired ratings around for when QLRanks is down.
+STALE_RETRY = 60
+BALANCE_ALGORITHMS = ("greedy", "optimal")
 ALPHANUMERICAL = re.compile(r"^[a-zA-Z0-9_]*$", flags=0)
 # Time window in seconds after round_countdown where players could switch right away with !a.
 AGREE_WINDOW = 7
+# How many ranges !histogram splits the ratings into.
+HISTOGRAM_BINS = 8
+# How long in seconds the lineup has to stay the same before we work out !teams and !balance for it.
+SPECULATION_DELAY = 1
 
 class balance(minqlbot.Plugin):
     def __init__(self):
         super().__init__()
+        teamstate.track(self)
         self.add_hook("vote_called", self.handle_vote_called, priority=minqlbot.PRI_HIGH)
         self.add_hook("vote_ended", self.handle_vote_ended)
         self.add_hook("player_connect", self.handle_player_connect)
+        self.add_hook("player_disconnect", self.handle_player_disconnect)
+        self.add_hook("bot_connect", self.handle_bot_connect)
+        self.add_hook("game_countdown", self.handle_game_countdown)
         self.add_hook("team_switch", self.handle_team_switch)
         self.add_hook("round_countdown", self.handle_round_countdown)
         self.add_hook("game_end", self.handle_game_end)
@@ -72,20 +93,51 @@ class balance(minqlbot.Plugin):
         self.add_command(("setrating", "setelo"), self.cmd_setrating, 3, usage="<full_name> <rating>")
         self.add_command(("getrating", "getelo", "elo"), self.cmd_getrating, usage="<full_name>")
         self.add_command(("remrating", "remelo"), self.cmd_remrating, 3, usage="<full_name>")
+        self.add_command("percentile", self.cmd_percentile, usage="[full_name]")
+        self.add_command(("histogram", "hist"), self.cmd_histogram)
 
         self.suggested_pair = None
         self.suggested_agree = [False, False]
 
         self.rlock = RLock()
 
-        # Keys: QlRanks().uid - Items: (QlRanks(), names, channel)
+        # Keys: QlRanks().uid - Items: (QlRanks(), names, channel, game_type)
         self.lookups = {}
-        # Keys: player_name - Items: {"ffa": {"elo": 123, rank: 321}, ...}
-        self.cache = {}
-        # Pending balancing, teams info, and so on. Format: (type, channel)
-        self.pending = []
-        # How many times we've failed a request in a row so we don't loop forever.
-        self.fails = 0
+        # Keys: player_name - Items: concurrent.futures.Future, done when the lookup the player is in is done.
+        self.in_flight = {}
+        # Connect lookups waiting for the batch window to end. Keys: (game_type, check_alias) - Items: [player_name, ...]
+        self.batch = {}
+        self.batch_timer = None
+        # Ratings by player name and game type, see plugins/ratingcache.
+        self.cache = ratingcache.RatingCache()
+        self.configure_cache()
+        # QLRanks ratings are also kept in the database so that they survive restarts.
+        self.db_query("CREATE TABLE IF NOT EXISTS CachedRatings (name TEXT NOT NULL, game_type TEXT NOT NULL, "
+                      "rating INT NOT NULL, rank INT NOT NULL, alias_of TEXT, fetched DATE NOT NULL, "
+                      "PRIMARY KEY (name, game_type))")
+        # Finished games and the ratings we've worked out from them.
+        self.db_query("CREATE TABLE IF NOT EXISTS Games (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                      "game_type TEXT NOT NULL, map TEXT, red_score INT, blue_score INT, winner TEXT, "
+                      "finished DATE NOT NULL)")
+        self.db_query("CREATE TABLE IF NOT EXISTS GamePlayers (game_id INT NOT NULL, name TEXT NOT NULL, "
+                      "team TEXT NOT NULL, rating INT, PRIMARY KEY (game_id, name), "
+                      "FOREIGN KEY(game_id) REFERENCES Games(id) ON DELETE CASCADE)")
+        self.db_query("CREATE TABLE IF NOT EXISTS GlickoRatings (name TEXT NOT NULL, game_type TEXT NOT NULL, "
+                      "rating REAL NOT NULL, deviation REAL NOT NULL, games INT NOT NULL, updated DATE NOT NULL, "
+                      "PRIMARY KEY (name, game_type))")
+        # How many players we've seen at every rating, and the rating each of them was counted with.
+        self.db_query("CREATE TABLE IF NOT EXISTS RatingDistribution (game_type TEXT NOT NULL, bucket INT NOT NULL, "
+                      "count INT NOT NULL, PRIMARY KEY (game_type, bucket))")
+        self.db_query("CREATE TABLE IF NOT EXISTS DistributionPlayers (name TEXT NOT NULL, game_type TEXT NOT NULL, "
+                      "rating INT NOT NULL, PRIMARY KEY (name, game_type))")
+        self.db_commit()
+        # Keys: game_type - Items: ratingsketch.RatingHistogram()
+        self.distributions = {}
+        for row in self.db_query("SELECT * FROM RatingDistribution"):
+            self.distribution(row["game_type"]).set_bucket(row["bucket"], row["count"])
+        # Tasks waiting for ratings, such as balancing and teams info. Keys: (callable, game_type,
+        # player names, id(channel)) - Items: [number of lookups left, whether they've all succeeded so far]
+        self.waiting = {}
 
         # We flag players who ought to be kickbanned, but since we delay it, we keep
         # a list of players who are flagged and prevent them from starting votes or joining.
@@ -95,6 +147,22 @@ class balance(minqlbot.Plugin):
         # A datetime.datetime instance of the point in time of the last round countdown.
         self.countdown = None
 
+        # The game type we last fetched everyone's ratings for, so we can tell when it changes.
+        self.prewarmed_type = None
+
+        # What !teams and !ratings last worked out.
+        # Keys: (game_type, red_names, blue_names, cache.version, number of alternatives)
+        self.analyses = {}
+        # The moves !balance last worked out. Keys: (game_type, red_names, blue_names, cache.version, algorithm)
+        self.plans = {}
+        # Pending speculate() while the lineup is still changing.
+        self.speculation_timer = None
+
+        # The rating requirements, and whether players meet them.
+        # Keys: (player_name, game_type) - Items: (rating, allowed)
+        self.rating_limits = self.read_rating_limits()
+        self.admissions = {}
+
     def handle_vote_called(self, caller, vote, args):
         if self.is_flagged(caller):
             self.vote_no()
@@ -104,7 +172,7 @@ class balance(minqlbot.Plugin):
         if vote == "shuffle" and "Balance" in config:
             auto_reject = config["Balance"].getboolean("VetoUnevenShuffleVote", fallback=False)
             if auto_reject:
-                teams = self.teams()
+                teams = teamstate.tracker.teams(self)
                 if len(teams["red"] + teams["blue"]) % 2 == 1:
                     self.vote_no()
                     self.msg("^7Only call shuffle votes when the total number of players is an even number.")
@@ -119,7 +187,7 @@ class balance(minqlbot.Plugin):
             if not auto:
                 return
             else:
-                teams = self.teams()
+                teams = teamstate.tracker.teams(self)
                 total = len(teams["red"]) + len(teams["blue"])
                 if total % 2 == 0:
                     self.delay(5, self.average_balance, args=(minqlbot.CHAT_CHANNEL, self.game().short_type))
@@ -127,12 +195,31 @@ class balance(minqlbot.Plugin):
                     self.msg("^7I can't balance when the total number of players is not an even number.")
 
     def handle_player_connect(self, player):
+        self.lineup_changed()
         gametype = self.game().short_type
-        if not self.is_cached(player.clean_name, gametype):
-            self.fetch_player_ratings([player.clean_name.lower()], None, gametype)
+        if gametype != self.prewarmed_type:
+            self.prewarm(gametype)
+        if not self.is_cached(player.clean_name.lower(), gametype):
+            self.fetch_player_ratings([player.clean_name.lower()], None, gametype, batch=True)
         self.check_rating_requirements([player.clean_name.lower()], None, gametype)
 
+    def handle_player_disconnect(self, player, reason):
+        self.lineup_changed()
+        name = player.clean_name.lower()
+        with self.rlock:
+            for key in [k for k in self.admissions if k[0] == name]:
+                del self.admissions[key]
+
+    def handle_bot_connect(self):
+        self.prewarm(self.game().short_type)
+
+    def handle_game_countdown(self):
+        gametype = self.game().short_type
+        if gametype != self.prewarmed_type:
+            self.prewarm(gametype)
+
     def handle_team_switch(self, player, old_team, new_team):
+        self.lineup_changed()
         if new_team != "spectator":
             if self.is_flagged(player):
                 player.put("spectator")
@@ -146,6 +233,8 @@ class balance(minqlbot.Plugin):
             self.execute_suggestion()
         
         self.countdown = datetime.datetime.now()
+        self.schedule_speculation()
+        self.refresh_stale()
 
     def handle_game_end(self, game, score, winner):
         # Clear suggestion when the game ends to avoid weird behavior if a pending switch
@@ -153,10 +242,88 @@ class balance(minqlbot.Plugin):
         self.suggested_pair = None
         self.suggested_agree = [False, False]
 
+        # Games are always saved, since replaying them is what the sweep is for.
+        result = self.record_game(game, score, winner)
+        config = minqlbot.get_config()
+        if result and "Balance" in config and config["Balance"].getboolean("UseGlickoRatings", fallback=False):
+            self.update_glicko(*result)
+        self.refresh_stale()
+
+    def record_game(self, game, score, winner):
+        """Save the result of a team game along with everyone who was on a team when it
+        ended and the rating they had going in. The score is (red_score, blue_score), as
+        passed to game_end.
+
+        Returns a tuple (game_type, red, blue, winner) with the names of the players on
+        each team for update_glicko(), or None if nobody was on red or blue.
+
+        """
+        teams = teamstate.tracker.teams(self)
+        if not teams["red"] or not teams["blue"]:
+            return
+
+        game_type = game.short_type
+        red_score, blue_score = score
+        if winner not in ("red", "blue"):
+            if red_score == blue_score:
+                winner = None
+            else:
+                winner = "red" if red_score > blue_score else "blue"
+
+        now = datetime.datetime.now()
+        c = self.db_query("INSERT INTO Games VALUES(NULL, ?, ?, ?, ?, ?, ?)", game_type,
+                          getattr(game, "map", None), red_score, blue_score, winner, now.strftime(TIME_FORMAT))
+        game_id = c.lastrowid
+        # Keep the ratings everyone had going in, so the game can be replayed later.
+        rows = []
+        for team in ("red", "blue"):
+            for player in teams[team]:
+                name = player.clean_name.lower()
+                cached = self.cache.get(name, game_type)
+                if not cached:
+                    rating = None
+                else:
+                    rating = cached.elo if cached.real_elo is None else cached.real_elo
+                rows.append((game_id, name, team, rating))
+        self.db_querymany("INSERT OR REPLACE INTO GamePlayers VALUES(?, ?, ?, ?)", *rows)
+        self.db_commit()
+
+        red = [p.clean_name.lower() for p in teams["red"]]
+        blue = [p.clean_name.lower() for p in teams["blue"]]
+        return game_type, red, blue, winner
+
+    def update_glicko(self, game_type, red, blue, winner):
+        """Update the Glicko ratings of everyone who played in a game.
+
+        """
+        now = datetime.datetime.now()
+        current = {}
+        for name in red + blue:
+            c = self.db_query("SELECT * FROM GlickoRatings WHERE name=? AND game_type=?", name, game_type)
+            row = c.fetchone()
+            if row:
+                updated = datetime.datetime.strptime(row["updated"], TIME_FORMAT)
+                deviation = glicko.inflate(row["deviation"], (now - updated).total_seconds() / 86400)
+                current[name] = (row["rating"], deviation, row["games"])
+            else:
+                current[name] = (glicko.DEFAULT_RATING, glicko.DEFAULT_DEVIATION, 0)
+
+        result = {"red": 1, "blue": 0, None: 0.5}[winner]
+        new_red, new_blue = glicko.rate_teams([current[n][:2] for n in red], [current[n][:2] for n in blue], result)
+        updates = [(n, game_type, r, d, current[n][2] + 1, now.strftime(TIME_FORMAT))
+                   for n, (r, d) in zip(red + blue, new_red + new_blue)]
+        self.db_querymany("INSERT OR REPLACE INTO GlickoRatings VALUES(?, ?, ?, ?, ?, ?)", *updates)
+        self.db_commit()
+
+        # Get rid of the old ones so the new ratings are picked up next time.
+        with self.rlock:
+            for name in red + blue:
+                self.cache.remove(name, game_type)
+
     def cmd_teams(self, player, msg, channel):
         """Displays the average ratings of each team, the difference between those values,
         as well as a switch suggestion that the bot determined would improve balance."""
-        teams = self.teams()
+        teams = teamstate.tracker.teams(self)
         diff = len(teams["red"]) - len(teams["blue"])
         if not diff:
             self.teams_info(channel, self.game().short_type)
@@ -166,7 +333,7 @@ class balance(minqlbot.Plugin):
     def cmd_balance(self, player, msg, channel):
         """Makes the bot switch players around in an attempt to create balanced teams based
         on ratings."""
-        teams = self.teams()
+        teams = teamstate.tracker.teams(self)
         total = len(teams["red"]) + len(teams["blue"])
         if total % 2 == 0:
             self.average_balance(channel, self.game().short_type)
@@ -218,8 +385,8 @@ class balance(minqlbot.Plugin):
             self.db_query("INSERT INTO Ratings VALUES(?, ?, ?)", name, short_game_type, rating)
             self.db_commit()
             channel.reply("^6{}^7 was added as a player with a ^6{}^7 {} rating.".format(msg[1], rating, game.type))
-            if name in self.cache and short_game_type in self.cache[name]:
-                del self.cache[name][short_game_type]
+            self.cache.remove(name, short_game_type)
+            self.update_distributions([(name, short_game_type, rating)])
             return
 
         c = self.db_query("SELECT game_type FROM Ratings WHERE name=?", name)
@@ -229,16 +396,16 @@ class balance(minqlbot.Plugin):
                 self.db_query("UPDATE Ratings SET rating=? WHERE name=? AND game_type=?", rating, name, short_game_type)
                 self.db_commit()
                 channel.reply("^6{}^7's {} rating has been updated to ^6{}^7.".format(msg[1], game.type, rating))
-                if name in self.cache and short_game_type in self.cache[name]:
-                    del self.cache[name][short_game_type]
+                self.cache.remove(name, short_game_type)
+                self.update_distributions([(name, short_game_type, rating)])
                 return
 
         # We have the player, but the rating isn't set.
         self.db_query("INSERT INTO Ratings VALUES(?, ?, ?)", name, short_game_type, rating)
         self.db_commit()
         channel.reply("^6{}^7's {} rating was set to ^6{}^7.".format(msg[1], game.type, rating))
-        if name in self.cache and short_game_type in self.cache[name]:
-            del self.cache[name][short_game_type]
+        self.cache.remove(name, short_game_type)
+        self.update_distributions([(name, short_game_type, rating)])
         return
 
     def cmd_getrating(self, player, msg, channel):
@@ -277,14 +444,39 @@ class balance(minqlbot.Plugin):
         else:
             self.db_commit()
             channel.reply("^6{}^7's {} rating data has been removed.".format(msg[1], game.type))
-            if name in self.cache and short_game_type in self.cache[name]:
-                del self.cache[name][short_game_type]
+            self.cache.remove(name, short_game_type)
             return
 
-    def fetch_player_ratings(self, names, channel, game_type, use_local=True, use_aliases=True):
+    def cmd_percentile(self, player, msg, channel):
+        """Tell how someone's rating compares to everyone else's we've seen on the server."""
+        if len(msg) < 2:
+            name = player.clean_name.lower()
+        else:
+            name = self.clean_text(msg[1]).lower()
+
+        if not self.is_sane([name]):
+            return
+
+        self.rating_percentile(name, channel, self.game().short_type)
+
+    def cmd_histogram(self, player, msg, channel):
+        """Show how the ratings of the players we've seen on the server are spread out."""
+        game = self.game()
+        distribution = self.distribution(game.short_type)
+        if not distribution.total:
+            channel.reply("^7I haven't seen any {} ratings yet.".format(game.type))
+            return
+
+        bins = ", ".join(["^6{}-{}^7: {}".format(low, high, count) for low, high, count in distribution.histogram(HISTOGRAM_BINS)])
+        channel.reply("^7{} ratings of ^6{}^7 players, median ^6{}^7. {}"
+            .format(game.type, distribution.total, distribution.quantile(0.5), bins))
+
+    def fetch_player_ratings(self, names, channel, game_type, use_local=True, use_aliases=True, batch=False):
         """Fetch ratings from the database and fall back to QLRanks.
 
         Takes into account ongoing lookups to avoid sending multiple requests for a player.
+        If batch is set, the QLRanks lookup waits a little for other players to look up
+        along with it instead of being sent right away.
 
         """
         config = minqlbot.get_config()
@@ -304,17 +496,21 @@ class balance(minqlbot.Plugin):
             if ratings["players"]:
                 self.cache_players(ratings, None)
 
-        # If we've covered everyone, we execute whatever pending tasks we have.
+        # Then the ratings we've worked out ourselves from games played here.
+        if names and use_local and "Balance" in config and config["Balance"].getboolean("UseGlickoRatings", fallback=False):
+            self.load_glicko_ratings(names, game_type)
+
+        # Then check if we've fetched them from QLRanks recently enough.
+        if names and game_type in QLRANKS_GAMETYPES:
+            self.load_cached_ratings(names, game_type)
+
+        # If we've covered everyone, there's nothing left to do.
         if not names:
-            self.execute_pending()
             return
 
         # Remove players we're already waiting a response for.
         with self.rlock:
-            for lookup in self.lookups:
-                for n in self.lookups[lookup][1]:
-                    if n in names:
-                        names.remove(n)
+            names = [n for n in names if n not in self.in_flight]
 
         # We fall back to QLRanks for players we don't have, but stop if we want a gametype it doesn't provide.
         if names and game_type in QLRANKS_GAMETYPES:
@@ -322,34 +518,164 @@ class balance(minqlbot.Plugin):
                 conf_alias = config["Balance"].getboolean("UseAliases", fallback=True)
             else:
                 conf_alias = False
-            lookup = qlranks.QlRanks(self, names, check_alias=conf_alias)
-            with self.rlock:
-                self.lookups[lookup.uid] = (lookup, names, channel)
-            lookup.start()
+            # Don't bother if QLRanks has been failing. Go with whatever we've got instead.
+            if not qlranks.breaker.allow():
+                self.load_cached_ratings(names, game_type, stale=True)
+                if names and channel:
+                    channel.reply("^7QLRanks seems to be down. I'll try again in ^6{}^7 seconds."
+                        .format(max(1, round(qlranks.breaker.retry_in()))))
+                return False
+
+            if batch and self.batch_window():
+                self.queue_lookups(names, game_type, conf_alias)
+            else:
+                self.start_lookups(names, channel, game_type, conf_alias)
             return True
         else:
             return False
 
-    def cache_players(self, ratings, lookup):
-        """Save the ratings of a player to the cache.
+    def start_lookups(self, names, channel, game_type, check_alias):
+        """Start looking up players on QLRanks. If there's too many of them to fit in one
+        request, they're split into several that are sent in parallel.
+
+        """
+        chunks = [[]]
+        length = 0
+        for name in names:
+            if chunks[-1] and length + len(name) + 1 > MAX_NICKS_LENGTH:
+                chunks.append([])
+                length = 0
+            chunks[-1].append(name)
+            length += len(name) + 1
+
+        with self.rlock:
+            lookups = []
+            for chunk in chunks:
+                # The lookup replaces aliases in its list with real names, so give it a copy.
+                lookup = qlranks.QlRanks(self, chunk.copy(), check_alias=check_alias)
+                self.lookups[lookup.uid] = (lookup, chunk, channel, game_type)
+                for name in chunk:
+                    # Batched players already have one.
+                    if name not in self.in_flight:
+                        self.in_flight[name] = concurrent.futures.Future()
+                lookups.append(lookup)
+
+        for lookup in lookups:
+            lookup.start()
+
+    def queue_lookups(self, names, game_type, check_alias):
+        """Add players to the next batch of QLRanks lookups, starting the batch window if
+        it's not already running. They count as in-flight right away, so anyone else that
+        needs them will wait for the batch instead of sending their own request.
+
+        """
+        with self.rlock:
+            for name in names:
+                if name in self.in_flight:
+                    continue
+                self.in_flight[name] = concurrent.futures.Future()
+                self.batch.setdefault((game_type, check_alias), []).append(name)
+            if not self.batch_timer:
+                self.batch_timer = self.delay(self.batch_window(), self.flush_batch)
+
+    def flush_batch(self):
+        """Send everything that was queued during the batch window.
+
+        """
+        with self.rlock:
+            batch = self.batch
+            self.batch = {}
+            self.batch_timer = None
+
+        for game_type, check_alias in batch:
+            self.start_lookups(batch[(game_type, check_alias)], None, game_type, check_alias)
+
+    def batch_window(self):
+        """How long in seconds to hold connect lookups for so they can be sent together.
 
         """
         config = minqlbot.get_config()
+        if "Balance" in config:
+            return int(config["Balance"].get("LookupBatchWindow", fallback="250")) / 1000
+        else:
+            return 0.25
+
+    def prewarm(self, game_type):
+        """Fetch the ratings of everyone on the server in the background, so that the
+        first !teams or !balance can be answered from the cache. Goes through the batch
+        window, so it ends up in the same request as anyone connecting meanwhile.
+
+        """
+        self.prewarmed_type = game_type
+
+        def run():
+            try:
+                names = self.not_cached(game_type, self.players())
+                if names:
+                    self.fetch_player_ratings(names, None, game_type, batch=True)
+            finally:
+                self.db_close()
+
+        threading.Thread(target=run).start()
+
+    def refresh_stale(self):
+        """Fetch stale ratings that have been used again in the background, all in one go.
+        Only called at quiet times like warmup and round countdowns. The stale ratings keep
+        being used until the new ones are in, so nobody ever waits for this.
 
+        """
+        stale = {}
+        for name, game_type in self.cache.pop_stale():
+            stale.setdefault(game_type, []).append(name)
+        if not stale:
+            return
+
+        def run():
+            try:
+                for game_type, names in stale.items():
+                    with self.rlock:
+                        names = [n for n in names if n not in self.in_flight]
+                    if names:
+                        self.fetch_player_ratings(names, None, game_type, batch=True)
+            finally:
+                self.db_close()
+
+        threading.Thread(target=run).start()
+
+    def configure_cache(self):
+        """Apply the cache size, expiry times, stale grace period and rating floor and ceiling from the config.
+
+        """
+        config = minqlbot.get_config()
+        size = 2000
+        hours = 24
+        no_data_hours = 2
+        floor = 0
+        ceiling = 0
+        stale_hours = 24
+        if "Balance" in config:
+            size = int(config["Balance"].get("CacheSize", fallback=size))
+            hours = float(config["Balance"].get("CacheHours", fallback=hours))
+            no_data_hours = float(config["Balance"].get("CacheNoDataHours", fallback=no_data_hours))
+            floor = int(config["Balance"].get("FloorRating", fallback=floor))
+            ceiling = int(config["Balance"].get("CeilingRating", fallback=ceiling))
+            stale_hours = float(config["Balance"].get("CacheStaleHours", fallback=stale_hours))
+
+        self.cache.configure(size, hours * 3600, no_data_hours * 3600, floor, ceiling, stale_hours * 3600)
+
+    def cache_players(self, ratings, lookup):
+        """Save the ratings of a player to the cache.
+
+        """
         if ratings == None:
             self.lookup_failed(lookup)
             return
         else:
-            floor = 0
-            ceiling = 0
-            if "Balance" in config:
-                if "FloorRating" in config["Balance"]:
-                    floor = int(config["Balance"]["FloorRating"])
-                if "CeilingRating" in config["Balance"]:
-                    ceiling = int(config["Balance"]["CeilingRating"])
-
-            with self.rlock:
-                self.fails = 0 # Reset fail counter.
+            # Rows for CachedRatings, if these came straight from QLRanks.
+            rows = []
+            # Items: (player_name, game_type, rating)
+            counted = []
+            now = datetime.datetime.now().strftime(TIME_FORMAT)
             for player in ratings["players"]:
                 name = player["nick"]
                 del player["nick"]
@@ -357,53 +683,173 @@ class balance(minqlbot.Plugin):
                 for game_type in player:
                     if game_type == "alias_of": # Not a game type.
                         continue
-                    # Enforce floor and ceiling values if we have them.
-                    if floor and player[game_type]["elo"] < floor:
-                        player[game_type]["real_elo"] = player[game_type]["elo"]
-                        player[game_type]["elo"] = floor
-                    elif ceiling and player[game_type]["elo"] > ceiling:
-                        player[game_type]["real_elo"] = player[game_type]["elo"]
-                        player[game_type]["elo"] = ceiling
+                    if lookup:
+                        rank = player[game_type]["rank"]
+                        rating = player[game_type]["elo"]
+                        rows.append((name, game_type, rating, rank, player.get("alias_of"), now))
+                        if "alias_of" in player:
+                            rows.append((player["alias_of"], game_type, rating, rank, None, now))
 
                 with self.rlock:
                     # If it's an alias, go ahead and cache the real one as well.
+                    # Ratings loaded from CachedRatings keep the time they were fetched at.
                     if "alias_of" in player:
                         real_name = player["alias_of"]
-                        self.cache[real_name] = player.copy()
-                        # Make sure real name isn't treated as alias.
-                        del self.cache[real_name]["alias_of"]
-
-                    if name not in self.cache: # Already in our cache?
-                        self.cache[name] = player
-                    else:
-                        if "alias_of" in player:
-                            self.cache[name]["alias_of"] = player["alias_of"]
-                        # Gotta be careful not to overwrite game types we've manually set ratings for.
                         for game_type in player:
-                            if game_type not in self.cache[name] and game_type != "alias_of":
-                                self.cache[name][game_type] = player[game_type]
+                            if game_type != "alias_of":
+                                r = player[game_type]
+                                self.cache.set(real_name, game_type, r["elo"], r["rank"], r.get("fetched"))
+                        self.cache.set_alias(name, real_name)
+
+                    # Gotta be careful not to overwrite game types we've manually set ratings for.
+                    # Stale ones are fair game, since this could be their refresh.
+                    for game_type in player:
+                        if game_type != "alias_of" and not self.cache.has(name, game_type, stale=False):
+                            r = player[game_type]
+                            self.cache.set(name, game_type, r["elo"], r["rank"], r.get("fetched"))
+
+                    # Count whatever we ended up with in the distribution, once per actual player.
+                    person = player.get("alias_of", name)
+                    for game_type in player:
+                        cached = self.cache.get(person, game_type) if game_type != "alias_of" else None
+                        if cached and cached.rank != 0:
+                            counted.append((person, game_type, cached.elo if cached.real_elo is None else cached.real_elo))
+
+            if counted:
+                self.update_distributions(counted)
+            if rows:
+                self.save_cached_ratings(rows)
         
             # The lookup's been dealt with, so we get rid of it.
             if lookup:
-                with self.rlock:
-                    del self.lookups[lookup.uid]
+                self.finish_lookup(lookup)
+
+    def load_glicko_ratings(self, names, game_type):
+        """Cache Glicko ratings we've worked out from games played here. Players we got
+        the game type we need for are removed from the list.
+
+        For game types QLRanks has, we only go with ours once we're sure enough of it,
+        that is once the deviation is down to GlickoMaxDeviation. For the rest, we've got
+        nothing better, so anything goes.
+
+        """
+        config = minqlbot.get_config()
+        max_deviation = float(config["Balance"].get("GlickoMaxDeviation", fallback="100"))
+        ratings = {"players": []}  # We follow QLRanks' JSON format.
+        for name in names.copy():
+            c = self.db_query("SELECT rating, deviation FROM GlickoRatings WHERE name=? AND game_type=?", name, game_type)
+            row = c.fetchone()
+            if not row:
+                continue
+            elif game_type in QLRANKS_GAMETYPES and row["deviation"] > max_deviation:
+                continue
+            # There's no rank outside of QLRanks, so -1 marks them as ours.
+            ratings["players"].append({"nick": name, game_type: {"elo": round(row["rating"]), "rank": -1}})
+            names.remove(name)
+
+        if ratings["players"]:
+            self.cache_players(ratings, None)
+
+    def distribution(self, game_type):
+        """Get the rating distribution of a game type.
+
+        """
+        with self.rlock:
+            if game_type not in self.distributions:
+                self.distributions[game_type] = ratingsketch.RatingHistogram()
+            return self.distributions[game_type]
+
+    def update_distributions(self, ratings):
+        """Count players in the rating distributions, moving them if they were already
+        counted with a different rating. Ratings are (name, game_type, rating) tuples.
+
+        """
+        players = []
+        buckets = {}
+        for name, game_type, rating in ratings:
+            c = self.db_query("SELECT rating FROM DistributionPlayers WHERE name=? AND game_type=?", name, game_type)
+            row = c.fetchone()
+            if row and row["rating"] == rating:
+                continue
+
+            with self.rlock:
+                distribution = self.distribution(game_type)
+                if row:
+                    distribution.remove(row["rating"])
+                    buckets[(game_type, distribution.bucket(row["rating"]))] = distribution
+                distribution.add(rating)
+                buckets[(game_type, distribution.bucket(rating))] = distribution
+            players.append((name, game_type, rating))
+
+        if players:
+            self.db_querymany("INSERT OR REPLACE INTO DistributionPlayers VALUES(?, ?, ?)", *players)
+            self.db_querymany("INSERT OR REPLACE INTO RatingDistribution VALUES(?, ?, ?)",
+                *[(game_type, bucket, d.counts[bucket]) for (game_type, bucket), d in buckets.items()])
+            self.db_commit()
+
+    def load_cached_ratings(self, names, game_type, stale=False):
+        """Cache QLRanks ratings we've saved in the database, as long as they haven't expired.
+        Players we got the game type we need for are removed from the list.
+
+        If stale is set, expired ratings are used too, since they're better than nothing
+        while QLRanks is down. They're kept until it's time to try QLRanks again.
+
+        """
+        ratings = {"players": []}  # We follow QLRanks' JSON format.
+        now = datetime.datetime.now().timestamp()
+        for name in names.copy():
+            c = self.db_query("SELECT * FROM CachedRatings WHERE name=?", name)
+            d = {"nick": name}
+            for row in c:
+                fetched = datetime.datetime.strptime(row["fetched"], TIME_FORMAT).timestamp()
+                ttl = self.cache.no_data_ttl if row["rank"] == 0 else self.cache.ttl
+                if now - fetched >= ttl:
+                    if not stale:
+                        continue
+                    # Pretend it was fetched just long enough ago to expire when we retry.
+                    fetched = now - ttl + max(qlranks.breaker.retry_in(), STALE_RETRY)
+                d[row["game_type"]] = {"elo": row["rating"], "rank": row["rank"], "fetched": fetched}
+                if row["alias_of"]:
+                    d["alias_of"] = row["alias_of"]
+            if game_type in d:
+                names.remove(name)
+            if len(d) > 1:
+                ratings["players"].append(d)
+
+        if ratings["players"]:
+            self.cache_players(ratings, None)
+
+    def save_cached_ratings(self, rows):
+        """Save freshly fetched QLRanks ratings to the database in one go.
+
+        Rows are (name, game_type, rating, rank, alias_of, fetched) tuples.
+
+        """
+        self.db_querymany("INSERT OR REPLACE INTO CachedRatings VALUES(?, ?, ?, ?, ?, ?)", *rows)
+        self.db_commit()
+        # We're on the lookup's thread, so close its connection like QlRanks does.
+        self.db_close()
+
+    def remove_cached(self, name):
+        """Forget everything we've cached about a player, both in memory and in the database.
+
+        """
+        self.db_query("DELETE FROM CachedRatings WHERE name=?", name)
+        self.db_commit()
+        return self.cache.remove(name)
 
     def is_cached(self, name, game_type):
         """Checks if a player is cached or not.
 
         """
-        with self.rlock:
-            if name in self.cache and game_type in self.cache[name]:
-                return True
-            else:
-                return False
+        return self.cache.has(name, game_type)
 
     def not_cached(self, game_type, player_list=None):
         """Get a list of players that are not cached.
 
         """
         not_cached = []
-        teams = self.teams()
+        teams = teamstate.tracker.teams(self)
         if player_list == None:
             players = teams["red"] + teams["blue"] + teams["spectator"]
         else:
@@ -418,76 +864,103 @@ class balance(minqlbot.Plugin):
         return not_cached
     
     def lookup_failed(self, lookup):
-        """Handle lookups that failed due to timeouts and such
+        """Handle lookups that failed due to timeouts and such. We fall back to whatever
+        QLRanks ratings we've saved before, no matter how old.
 
         """
         with self.rlock:
-            self.fails += 1
-            if self.fails < FAILS_ALLOWED or self.lookups[lookup.uid][2] == None:
-                del self.lookups[lookup.uid]
+            if lookup.uid not in self.lookups:
+                return
+            names, channel, game_type = self.lookups[lookup.uid][1:]
+            missing = names.copy()
+            self.load_cached_ratings(missing, game_type, stale=True)
+            # We're on the lookup's thread, so close its connection like QlRanks does.
+            self.db_close()
+            self.finish_lookup(lookup)
+            if not missing or channel == None:
                 return
             elif lookup.status == -2:
                 err_msg = "^7The connection to QLRanks timed out."
             else:
                 err_msg = "^7The connection to QLRanks failed with error code: ^6{}".format(lookup.status)
-            channel = self.lookups[lookup.uid][2]
             channel.reply(err_msg)
-            del self.lookups[lookup.uid]
 
-    def execute_pending(self):
-        """Checks for pending tasks and execute them.
+    def finish_lookup(self, lookup):
+        """Get rid of a lookup that's been dealt with and let anyone waiting on its
+        players know whether or not we've got their ratings now.
 
         """
-        # If limit is hit, clear pending requests and fail counter, then do nothing.
-        # We don't want to keep requesting if something's wrong, but rather let a player
-        # or an event trigger it again.
         with self.rlock:
-            if self.fails >= FAILS_ALLOWED:
-                self.fails = 0
-                self.pending.clear()
-                return
+            names, channel, game_type = self.lookups.pop(lookup.uid)[1:]
+            for name in names:
+                future = self.in_flight.pop(name, None)
+                if future:
+                    future.set_result(self.is_cached(name, game_type))
+
+    def wait_for_ratings(self, names, channel, game_type, task, use_local=True, use_aliases=True):
+        """Fetch the ratings of players that aren't already on their way, and run a task
+        once the last of them is in. Players that are already being looked up are left
+        to the lookup they're in, so we never send more than one request for a player.
 
+        Tasks are (callable, args) tuples. If the same callable is already waiting on the
+        same players for the same channel, it won't be queued again. If any of the lookups
+        fail, the task is dropped.
+
+        """
+        # The arguments can be players or channels that might not be hashable, so leave them out.
+        key = (task[0], game_type, tuple(names), id(channel))
         with self.rlock:
-            for task in self.pending.copy():
-                if task[0](*task[1]):
-                    self.pending.remove(task)
+            if key in self.waiting:
+                return
+
+            missing = [n for n in names if n not in self.in_flight]
+            if missing:
+                self.fetch_player_ratings(missing, channel, game_type, use_local, use_aliases)
+
+            futures = [self.in_flight[n] for n in names if n in self.in_flight]
+            if not futures:
+                # Everyone was found locally, or there's nowhere left to get them from.
+                if not self.not_cached(game_type, names):
+                    task[0](*task[1])
+                else:
+                    self.debug("Dropping {} since the ratings can't be fetched.".format(task[0].__name__))
+                return
+
+            self.waiting[key] = [len(futures), True]
+
+        def done(future):
+            with self.rlock:
+                state = self.waiting[key]
+                state[0] -= 1
+                state[1] = state[1] and future.result()
+                if state[0]:
+                    return
+                del self.waiting[key]
+            if state[1]:
+                task[0](*task[1])
+
+        for future in futures:
+            future.add_done_callback(done)
 
     def check_rating_requirements(self, names, channel, game_type):
         """Checks if someone meets the rating requirements to play on the server."""
-        config = minqlbot.get_config()
-        min_rating = 0
-        max_rating = 0
-        if "Balance" in config:
-            if "MinimumRating" in config["Balance"]:
-                min_rating = int(config["Balance"]["MinimumRating"])
-            if "MaximumRating" in config["Balance"]:
-                max_rating = int(config["Balance"]["MaximumRating"])
-        else:
-            return True
-
+        min_rating, max_rating = self.rating_limits
         if not min_rating and not max_rating:
             return True
 
-        not_cached = self.not_cached(game_type, names)
+        not_cached = [name for name in names if not self.admission(name, game_type)]
         if not_cached:
-            with self.rlock:
-                for lookup in self.lookups:
-                    for n in self.lookups[lookup][1]:
-                        if n in not_cached:
-                            not_cached.remove(n)
-                if not_cached:
-                    self.fetch_player_ratings(not_cached, channel, game_type)
-                if (self.check_rating_requirements, (names, channel, game_type)) not in self.pending:
-                    self.pending.append((self.check_rating_requirements, (names, channel, game_type)))
-                return False
+            self.wait_for_ratings(not_cached, channel, game_type, (self.check_rating_requirements, (names, channel, game_type)))
+            return False
 
+        config = minqlbot.get_config()
         for name in names:
-            if "real_elo" in self.cache[name][game_type]:
-                rating = self.cache[name][game_type]["real_elo"]
-            else:
-                rating = self.cache[name][game_type]["elo"]
+            admission = self.admission(name, game_type)
+            if not admission:
+                continue
+            rating, allowed = admission
 
-            if (rating > max_rating and max_rating != 0) or (rating < min_rating and min_rating != 0):
+            if not allowed:
                 allow_spec = config["Balance"].getboolean("AllowSpectators", fallback=True)
                 if allow_spec:
                     player = self.player(name)
@@ -514,55 +987,124 @@ class balance(minqlbot.Plugin):
 
         return True
 
+    def admission(self, name, game_type):
+        """Get whether a player meets the rating requirements, as a tuple (rating, allowed),
+        or None if we don't have their rating. The decision is kept until the player's
+        rating or the config changes.
+
+        """
+        cached = self.cache.get(name, game_type)
+        if not cached:
+            return None
+        # Requirements go by the actual rating, not the one clipped by the floor or ceiling.
+        rating = cached.elo if cached.real_elo is None else cached.real_elo
+        with self.rlock:
+            admission = self.admissions.get((name, game_type))
+            if admission and admission[0] == rating:
+                return admission
+
+            min_rating, max_rating = self.rating_limits
+            allowed = not ((rating > max_rating and max_rating != 0) or (rating < min_rating and min_rating != 0))
+            self.admissions[(name, game_type)] = (rating, allowed)
+            return (rating, allowed)
+
+    def read_rating_limits(self):
+        """Get the minimum and maximum rating from the config as a tuple. 0 means no limit.
+
+        """
+        config = minqlbot.get_config()
+        min_rating = 0
+        max_rating = 0
+        if "Balance" in config:
+            if "MinimumRating" in config["Balance"]:
+                min_rating = int(config["Balance"]["MinimumRating"])
+            if "MaximumRating" in config["Balance"]:
+                max_rating = int(config["Balance"]["MaximumRating"])
+        return min_rating, max_rating
+
+    def config_reloaded(self):
+        """Pick up the new config. Called by plugin_manager after !reloadconfig.
+
+        """
+        with self.rlock:
+            self.rating_limits = self.read_rating_limits()
+            self.admissions.clear()
+        self.configure_cache()
+
+    def rating_percentile(self, name, channel, game_type):
+        not_cached = self.not_cached(game_type, (name,))
+        if not_cached:
+            self.wait_for_ratings(not_cached, channel, game_type, (self.rating_percentile, (name, channel, game_type)))
+            return False
+
+        cached = self.cache.get(name, game_type)
+        distribution = self.distribution(game_type)
+        if not cached or cached.rank == 0 or not distribution.total:
+            channel.reply("^7I don't have enough data to tell for ^6{}^7.".format(name))
+            return True
+
+        rating = cached.elo if cached.real_elo is None else cached.real_elo
+        # Leave the player out if they've been counted, so they're only compared to everyone else.
+        c = self.db_query("SELECT rating FROM DistributionPlayers WHERE name=? AND game_type=?", name, game_type)
+        row = c.fetchone()
+        with self.rlock:
+            exclude = row["rating"] if row else None
+            percentile = distribution.percentile(rating, exclude)
+            others = distribution.total - (1 if row else 0)
+        if percentile is None:
+            channel.reply("^7I haven't seen anyone else to compare ^6{}^7 with.".format(name))
+            return True
+
+        channel.reply("^6{}^7's {} rating of ^6{}^7 is higher than ^6{}%^7 of the ^6{}^7 other players we've seen."
+            .format(name, game_type.upper(), rating, round(percentile), others))
+        return True
+
     def individual_rating(self, name, channel, game_type):
         not_cached = self.not_cached(game_type, (name,))
         if not_cached:
-            with self.rlock:
-                for lookup in self.lookups:
-                    for n in self.lookups[lookup][1]:
-                        if n in not_cached:
-                            not_cached.remove(n)
-                if not_cached:
-                    self.fetch_player_ratings(not_cached, channel, game_type, use_local=False, use_aliases=True)
-                if (self.individual_rating, (name, channel, game_type)) not in self.pending:
-                    self.pending.append((self.individual_rating, (name, channel, game_type)))
-                return False
+            self.wait_for_ratings(not_cached, channel, game_type, (self.individual_rating, (name, channel, game_type)),
+                                  use_local=False, use_aliases=True)
+            return False
 
         # NO DATA?
         short_game_type = game_type.upper()
-        if self.cache[name][game_type]["rank"] == 0:
+        cached = self.cache.get(name, game_type)
+        if cached.rank == 0:
             channel.reply("^7QLRanks has no data on ^6{}^7 for {}.".format(name, short_game_type))
             return True
+        # GLICKO? Only QLRanks ratings have a rank.
+        elif cached.rank < 0:
+            if cached.real_elo is not None: # Ceiling/floor clipped rating?
+                channel.reply("^6{}^7 is rated ^6{}^7 in {} from games played here, but treated as ^6{}^7."
+                    .format(name, cached.real_elo, short_game_type, cached.elo))
+            else:
+                channel.reply("^6{}^7 is rated ^6{}^7 in {} from games played here."
+                    .format(name, cached.elo, short_game_type))
+            return True
         # ALIAS?
-        elif "alias_of" in self.cache[name]:
-            if "real_elo" in self.cache[name][game_type]: # Ceiling/floor clipped rating?
-                real = self.cache[name][game_type]["real_elo"]
-                clipped = self.cache[name][game_type]["elo"]
+        elif self.cache.alias_of(name):
+            if cached.real_elo is not None: # Ceiling/floor clipped rating?
                 channel.reply("^6{}^7 is an alias of ^6{}^7, who is ranked #^6{}^7 in {} with a rating of ^6{}^7, but treated as ^6{}^7."
-                    .format(name, self.cache[name]["alias_of"], self.cache[name][game_type]["rank"],
-                            short_game_type, real, clipped))
+                    .format(name, self.cache.alias_of(name), cached.rank, short_game_type, cached.real_elo, cached.elo))
             else:
                 channel.reply("^6{}^7 is an alias of ^6{}^7, who is ranked #^6{}^7 in {} with a rating of ^6{}^7."
-                    .format(name, self.cache[name]["alias_of"], self.cache[name][game_type]["rank"],
-                            short_game_type, self.cache[name][game_type]["elo"]))
+                    .format(name, self.cache.alias_of(name), cached.rank, short_game_type, cached.elo))
             return True
         # NORMAL
         else:
-            if "real_elo" in self.cache[name][game_type]: # Ceiling/floor clipped rating?
-                real = self.cache[name][game_type]["real_elo"]
-                clipped = self.cache[name][game_type]["elo"]
+            if cached.real_elo is not None: # Ceiling/floor clipped rating?
                 channel.reply("^6{}^7 is ranked #^6{}^7 in {} with a rating of ^6{}^7, but treated as ^6{}^7."
-                    .format(name, self.cache[name][game_type]["rank"], short_game_type, real, clipped))
+                    .format(name, cached.rank, short_game_type, cached.real_elo, cached.elo))
             else:
                 channel.reply("^6{}^7 is ranked #^6{}^7 in {} with a rating of ^6{}^7."
-                    .format(name, self.cache[name][game_type]["rank"], short_game_type, self.cache[name][game_type]["elo"]))
+                    .format(name, cached.rank, short_game_type, cached.elo))
             return True
 
     def teams_info(self, channel, game_type):
         """Send average team ratings and an improvement suggestion to whoever asked for it.
 
         """
-        teams = self.teams()
+        teams = teamstate.tracker.teams(self)
         diff = len(teams["red"]) - len(teams["blue"])
         if diff:
             channel.reply("^7Both teams should have the same number of players.")
@@ -572,22 +1114,14 @@ class balance(minqlbot.Plugin):
         not_cached = self.not_cached(game_type, players)
         
         if not_cached:
-            with self.rlock:
-                for lookup in self.lookups:
-                    for n in self.lookups[lookup][1]:
-                        if n in not_cached:
-                            not_cached.remove(n)
-                if not_cached:
-                    self.fetch_player_ratings(not_cached, channel, game_type)
-                if (self.teams_info, (channel, game_type)) not in self.pending:
-                    self.pending.append((self.teams_info, (channel, game_type)))
-                # Let a later call to execute_pending come back to us.
-                return False
+            self.wait_for_ratings(not_cached, channel, game_type, (self.teams_info, (channel, game_type)))
+            # We'll be called again once the ratings are in.
+            return False
 
-        avg_red = self.team_average(teams["red"], game_type)
-        avg_blue = self.team_average(teams["blue"], game_type)
-        switch = self.suggest_switch(teams, game_type)
-        diff = len(teams["red"]) - len(teams["blue"])
+        analysis = self.analyze_teams(teams, game_type)
+        avg_red = analysis["avg_red"]
+        avg_blue = analysis["avg_blue"]
+        switch = analysis["switch"]
         diff_rounded = abs(round(avg_red) - round(avg_blue)) # Round individual averages.
         if round(avg_red) > round(avg_blue):
             channel.reply("^1{} ^7vs ^4{}^7 - DIFFERENCE: ^1{}"
@@ -619,13 +1153,21 @@ class balance(minqlbot.Plugin):
                 channel.reply("^7Teams look good!")
             self.suggested_pair = None
 
+        # Leave out the switch we just suggested, if we did.
+        alternatives = [(pair, p) for pair, p in analysis["alternatives"]
+                        if not self.suggested_pair or pair != self.suggested_pair][:self.teams_alternatives()]
+        if alternatives:
+            channel.reply("^7Red's chance of winning: ^6{}%^7. Closest to even: {}"
+                .format(round(analysis["probability"] * 100), ", ".join(["^6{}^7 <=> ^6{}^7 (^6{}%^7)"
+                    .format(pair[0].clean_name, pair[1].clean_name, round(p * 100)) for pair, p in alternatives])))
+
         return True
 
     def average_balance(self, channel, game_type):
         """Balance teams based on average team ratings.
 
         """
-        teams = self.teams()
+        teams = teamstate.tracker.teams(self)
         total = len(teams["red"]) + len(teams["blue"])
         if total % 2 == 1:
             channel.reply("^7I can't balance when the total number of players isn't an even number.")
@@ -635,52 +1177,41 @@ class balance(minqlbot.Plugin):
         not_cached = self.not_cached(game_type, players)
 
         if not_cached:
-            with self.rlock:
-                for lookup in self.lookups:
-                    for n in self.lookups[lookup][1]:
-                        if n in not_cached:
-                            not_cached.remove(n)
-                if not_cached:
-                    self.fetch_player_ratings(not_cached, channel, game_type)
-                if (self.average_balance, (channel, game_type)) not in self.pending:
-                    self.pending.append((self.average_balance, (channel, game_type)))
-                # Let a later call to execute_pending come back to us.
-                return False
+            self.wait_for_ratings(not_cached, channel, game_type, (self.average_balance, (channel, game_type)))
+            # We'll be called again once the ratings are in.
+            return False
         else:
-            # Start out by evening out the number of players on each team.
-            diff = len(teams["red"]) - len(teams["blue"])
-            if abs(diff) > 1:
-                channel.reply("^7Evening teams...")
-                if diff > 0:
-                    for i in range(diff - 1):
-                        p = teams["red"].pop()
-                        self.put(p, "blue")
-                        teams["blue"].append(p)
-                elif diff < 0:
-                    for i in range(abs(diff) - 1):
-                        p = teams["blue"].pop()
-                        self.put(p, "red")
-                        teams["red"].append(p)
-
-            # Start shuffling by looping through our suggestion function until
-            # there are no more switches that can be done to improve teams.
-            switch = self.suggest_switch(teams, game_type)
-            if switch:
+            players = teams["red"] + teams["blue"]
+            moves = self.plan_balance(teams, game_type)
+
+            if moves:
+                red = teams["red"]
+                blue = teams["blue"]
                 self.msg("^7Balancing teams...")
                 self.lock()
-                while switch:
-                    p1 = switch[0][0]
-                    p2 = switch[0][1]
-                    self.msg("^7{} ^6<=> ^7{}".format(p1, p2))
-                    self.switch(p1, p2)
-                    teams["blue"].append(p1)
-                    teams["red"].append(p2)
-                    teams["blue"].remove(p2)
-                    teams["red"].remove(p1)
-                    switch = self.suggest_switch(teams, game_type)
+                for move in moves:
+                    if move[0] == "switch":
+                        p1 = players[move[1]]
+                        p2 = players[move[2]]
+                        self.msg("^7{} ^6<=> ^7{}".format(p1, p2))
+                        self.switch(p1, p2)
+                        red.remove(p1)
+                        blue.remove(p2)
+                        red.append(p2)
+                        blue.append(p1)
+                    else:
+                        p = players[move[1]]
+                        self.msg("^7{} ^6=> ^7{}".format(p, move[2]))
+                        self.put(p, move[2])
+                        if move[2] == "red":
+                            blue.remove(p)
+                            red.append(p)
+                        else:
+                            red.remove(p)
+                            blue.append(p)
                 self.unlock()
-                avg_red = self.team_average(teams["red"], game_type)
-                avg_blue = self.team_average(teams["blue"], game_type)
+                avg_red = self.team_average(red, game_type)
+                avg_blue = self.team_average(blue, game_type)
                 diff_rounded = abs(round(avg_red) - round(avg_blue)) # Round individual averages.
                 if round(avg_red) > round(avg_blue):
                     self.msg("^7Done! ^1{} ^7vs ^4{}^7 - DIFFERENCE: ^1{}"
@@ -695,36 +1226,178 @@ class balance(minqlbot.Plugin):
                 channel.reply("^7Teams are good! Nothing to balance.")
             return True
 
+    def plan_balance(self, teams, game_type):
+        """Work out the moves that balance the teams, reusing the last result if nothing's
+        changed since. Players in the moves are identified by their position in red + blue.
+
+        Everyone on a team has to be cached.
+
+        """
+        algorithm = self.balance_algorithm()
+        with self.rlock:
+            key = (game_type, tuple(p.clean_name.lower() for p in teams["red"]),
+                   tuple(p.clean_name.lower() for p in teams["blue"]), self.cache.version, algorithm)
+            if key in self.plans:
+                return self.plans[key]
+
+            # Figure out where everyone should end up first, evening out the number of
+            # players on each team if needed, then get there with as few commands as possible.
+            ratings_red = self.team_ratings(teams["red"], game_type)
+            ratings_blue = self.team_ratings(teams["blue"], game_type)
+            if algorithm == "optimal":
+                target = teambalance.optimal_split(ratings_red, ratings_blue, self.optimal_time_budget())
+            else:
+                target = teambalance.greedy_split(ratings_red, ratings_blue)
+            moves = teambalance.plan_moves(len(teams["red"]), len(teams["blue"]), target)
+            self.plans.clear()
+            self.plans[key] = moves
+            return moves
+
+    def lineup_changed(self):
+        """Forget what we've worked out for the old lineup and start on the new one.
+
+        """
+        with self.rlock:
+            self.analyses.clear()
+            self.plans.clear()
+        if self.game().state == "warmup":
+            self.schedule_speculation()
+
+    def schedule_speculation(self):
+        """Have speculate() run once the lineup has stopped changing for a bit.
+
+        """
+        config = minqlbot.get_config()
+        if "Balance" not in config or not config["Balance"].getboolean("PrecomputeTeams", fallback=True):
+            return
+
+        with self.rlock:
+            if self.speculation_timer:
+                self.speculation_timer.cancel()
+            self.speculation_timer = self.delay(SPECULATION_DELAY, self.run_speculation)
+
+    def run_speculation(self):
+        with self.rlock:
+            self.speculation_timer = None
+        try:
+            self.speculate()
+        finally:
+            # We're on the timer's thread, so close the connection fetching ratings might've opened.
+            self.db_close()
+
+    def speculate(self):
+        """Work out what !teams and !balance would say about the current lineup ahead of
+        time, fetching any ratings we're missing first. The results are kept by
+        analyze_teams() and plan_balance() under the lineup and the version of the rating
+        cache, so the commands reply right away as long as both are still the same.
+
+        """
+        game_type = self.game().short_type
+        teams = teamstate.tracker.teams(self)
+        players = teams["red"] + teams["blue"]
+        # A good a time as any, since the lineup just settled in warmup or a round's about to start.
+        self.refresh_stale()
+        if not players:
+            return
+
+        not_cached = self.not_cached(game_type, players)
+        if not_cached:
+            # We'll be called again once the ratings are in.
+            self.wait_for_ratings(not_cached, None, game_type, (self.speculate, ()))
+            return
+
+        if len(teams["red"]) == len(teams["blue"]):
+            self.analyze_teams(teams, game_type)
+        if len(players) % 2 == 0:
+            self.plan_balance(teams, game_type)
+
+    def analyze_teams(self, teams, game_type):
+        """Work out the average ratings, the suggested switch and everyone's ratings sorted
+        from highest to lowest for both teams. As long as nobody's moved, connected or
+        disconnected and no ratings have changed, the last result is reused.
+
+        Everyone on a team has to be cached.
+
+        """
+        alternatives = self.teams_alternatives()
+        with self.rlock:
+            key = (game_type, tuple(p.clean_name.lower() for p in teams["red"]),
+                   tuple(p.clean_name.lower() for p in teams["blue"]), self.cache.version, alternatives)
+            if key in self.analyses:
+                return self.analyses[key]
+
+            red = self.team_ratings(teams["red"], game_type)
+            blue = self.team_ratings(teams["blue"], game_type)
+            evaluator = teambalance.SwapEvaluator(red, blue)
+            avg_red, avg_blue = evaluator.averages()
+            switch = evaluator.best_swap()
+            if switch:
+                switch = ((teams["red"][switch[0]], teams["blue"][switch[1]]), switch[2])
+
+            analysis = {"avg_red": avg_red, "avg_blue": avg_blue, "switch": switch,
+                        # Red's chance of winning, and the swaps that get it closest to 50%.
+                        # Items: ((red_player, blue_player), probability)
+                        "probability": teambalance.win_probability(avg_red - avg_blue),
+                        # One more than needed, in case one of them is the suggested switch.
+                        "alternatives": [((teams["red"][i], teams["blue"][j]), p)
+                                         for i, j, p in evaluator.top_swaps(alternatives + 1 if alternatives else 0)],
+                        # Items: (clean_name, rating)
+                        "red": sorted(((p.clean_name, r) for p, r in zip(teams["red"], red)), key=lambda x: x[1], reverse=True),
+                        "blue": sorted(((p.clean_name, r) for p, r in zip(teams["blue"], blue)), key=lambda x: x[1], reverse=True)}
+            # Anything else is outdated now.
+            self.analyses.clear()
+            self.analyses[key] = analysis
+            return analysis
+
     def suggest_switch(self, teams, game_type):
         """Suggest a switch based on average team ratings.
 
         """
-        avg_red = self.team_average(teams["red"], game_type)
-        avg_blue = self.team_average(teams["blue"], game_type)
-        cur_diff = abs(avg_red - avg_blue)
-        min_diff = 999999
-        best_pair = None
-
-        for red_p in teams["red"]:
-            for blue_p in teams["blue"]:
-                r = teams["red"].copy()
-                b = teams["blue"].copy()
-                b.append(red_p)
-                r.remove(red_p)
-                r.append(blue_p)
-                b.remove(blue_p)
-                avg_red = self.team_average(r, game_type)
-                avg_blue = self.team_average(b, game_type)
-                diff = abs(avg_red - avg_blue)
-                if diff < min_diff:
-                    min_diff = diff
-                    best_pair = (red_p, blue_p)
-
-        if min_diff < cur_diff:
-            return (best_pair, cur_diff - min_diff)
+        switch = teambalance.SwapEvaluator(self.team_ratings(teams["red"], game_type),
+                                           self.team_ratings(teams["blue"], game_type)).best_swap()
+        if switch:
+            return ((teams["red"][switch[0]], teams["blue"][switch[1]]), switch[2])
         else:
             return None
 
+    def teams_alternatives(self):
+        """How many alternative switches !teams should show.
+
+        """
+        config = minqlbot.get_config()
+        if "Balance" in config:
+            return max(int(config["Balance"].get("TeamsAlternatives", fallback="0")), 0)
+        else:
+            return 0
+
+    def balance_algorithm(self):
+        """Get the algorithm !balance should use. Either "greedy" or "optimal".
+
+        """
+        config = minqlbot.get_config()
+        if "Balance" in config:
+            algorithm = config["Balance"].get("Algorithm", fallback="greedy").strip().lower()
+            if algorithm in BALANCE_ALGORITHMS:
+                return algorithm
+
+        return "greedy"
+
+    def optimal_time_budget(self):
+        """How long in seconds the optimal algorithm is allowed to search for.
+
+        """
+        config = minqlbot.get_config()
+        if "Balance" in config:
+            return int(config["Balance"].get("OptimalTimeBudget", fallback="5")) / 1000
+        else:
+            return 0.005
+
+    def team_ratings(self, team, game_type):
+        """Get the cached ratings of a team's players, in the same order.
+
+        """
+        return self.cache.ratings([p.clean_name.lower() for p in team], game_type)
+
     def team_average(self, team, game_type):
         """Calculates the average rating of a team.
 
@@ -732,10 +1405,7 @@ class balance(minqlbot.Plugin):
         avg = 0
 
         if team:
-            with self.rlock:
-                for p in team:
-                    avg += self.cache[p.clean_name.lower()][game_type]["elo"]
-                avg /= len(team)
+            avg = sum(self.team_ratings(team, game_type)) / len(team)
 
         return avg
 
@@ -19,6 +19,8 @@
 import datetime
 import re
 import plugins.qlprofile as qlprofile
+import plugins.sanctions as sanctions
+import plugins.teamstate as teamstate
 import minqlbot
 import threading
 import traceback
@@ -30,6 +32,17 @@ DEFAULT_REASON = "Reason not specified."
 class ban(minqlbot.Plugin):
     def __init__(self):
         super().__init__()
+        # Active bans, so that checking players doesn't need the database. Any that ran
+        # out while we weren't running are marked inactive first.
+        now = datetime.datetime.now().strftime(TIME_FORMAT)
+        self.db_query("UPDATE Bans SET active=0 WHERE active=1 AND expires<=?", now)
+        self.db_commit()
+        self.bans = sanctions.SanctionIndex()
+        self.bans.load(self.db_query("SELECT name, expires, reason FROM Bans WHERE active=1"))
+        self.expiry = sanctions.ExpiryScheduler(self, self.bans, self.expire_bans)
+        self.expiry.schedule()
+
+        teamstate.track(self)
         self.add_hook("player_connect", self.handle_player_connect, minqlbot.PRI_HIGH)
         self.add_hook("player_disconnect", self.handle_player_disconnect)
         self.add_hook("game_countdown", self.handle_game_countdown)
@@ -38,6 +51,7 @@ class ban(minqlbot.Plugin):
         self.add_hook("game_end", self.handle_game_end)
         self.add_hook("team_switch", self.handle_team_switch)
         self.add_hook("vote_called", self.handle_vote_called)
+        self.add_hook("unload", self.handle_unload)
         self.add_command("ban", self.cmd_ban, 2, usage="<full_name> <length> seconds|minutes|hours|days|... [reason]")
         self.add_command("unban", self.cmd_unban, 2, usage="<full_name>")
         self.add_command("checkban", self.cmd_checkban, usage="<full_name>")
@@ -79,8 +93,7 @@ class ban(minqlbot.Plugin):
 
     def handle_player_disconnect(self, player, reason):
         # Allow people to disconnect without getting a leave if teams are uneven.
-        teams = self.teams()
-        if len(teams["red"] + teams["blue"]) % 2 == 0 and player in self.players_start:
+        if teamstate.tracker.count("red", "blue", plugin=self) % 2 == 0 and player in self.players_start:
             self.players_start.remove(player)
         
         if player in self.ban_flagged:
@@ -93,16 +106,16 @@ class ban(minqlbot.Plugin):
     def handle_bot_connect(self):
         if self.game().state == "in_progress":
             self.players_start = []
-            teams = self.teams()
+            teams = teamstate.tracker.teams(self)
             self.players_start = teams["red"] + teams["blue"]
 
     def handle_game_start(self, game):
         self.players_start = []
-        teams = self.teams()
+        teams = teamstate.tracker.teams(self)
         self.players_start = teams["red"] + teams["blue"]
 
     def handle_game_end(self, game, score, winner):
-        teams = self.teams()
+        teams = teamstate.tracker.teams(self)
         players_end = teams["red"] + teams["blue"]
         leavers = []
 
@@ -130,8 +143,7 @@ class ban(minqlbot.Plugin):
 
         # Allow people to spectate without getting a leave if teams are uneven.
         if (old_team == "red" or old_team == "blue") and new_team == "spectator":
-            teams = self.teams()
-            if len(teams["red"] + teams["blue"]) % 2 == 0 and player in self.players_start:
+            if teamstate.tracker.count("red", "blue", plugin=self) % 2 == 0 and player in self.players_start:
                 self.players_start.remove(player)
         # Add people to the list of participating players if they join mid-game.
         if (old_team == "spectator" and (new_team == "red" or new_team == "blue") and
@@ -142,6 +154,9 @@ class ban(minqlbot.Plugin):
         if self.is_flagged(caller):
             self.vote_no()
 
+    def handle_unload(self):
+        self.expiry.cancel()
+
     def cmd_ban(self, player, msg, channel):
         """Bans a player temporarily. A very long period works for all intents and
         purposes as a permanent ban, so there's no separate command for that.
@@ -194,6 +209,8 @@ class ban(minqlbot.Plugin):
             expires = (datetime.datetime.now() + td).strftime(TIME_FORMAT)
             self.db_query("INSERT INTO Bans VALUES(?, ?, ?, 1, ?)", name.lower(), now, expires, reason)
             self.db_commit()
+            self.bans.add(name, expires, reason)
+            self.expiry.schedule()
             self.kickban(name)
             channel.reply("^6{} ^7has been banned. Ban expires on ^6{}^7.".format(name, expires))
             return
@@ -212,6 +229,7 @@ class ban(minqlbot.Plugin):
                 self.db_commit()
                 unbanned = True
         
+        self.bans.remove(name)
         if unbanned:
             channel.reply("^6{}^7 has been unbanned.".format(name))
         else:
@@ -278,14 +296,18 @@ class ban(minqlbot.Plugin):
     # ====================================================================
 
     def is_banned(self, name):
-        clean = self.clean_name(name).lower()
-        c = self.db_query("SELECT * FROM Bans WHERE name=?", clean)
-        for row in c:
-            if clean == row["name"] and row["active"]:
-                expires = datetime.datetime.strptime(row["expires"], TIME_FORMAT)
-                if (expires - datetime.datetime.now()).total_seconds() > 0:
-                    return row["expires"], row["reason"]
-        return None
+        return self.bans.get(self.clean_name(name))
+
+    def expire_bans(self, names):
+        """Mark bans that have run out as inactive, all in one go."""
+        now = datetime.datetime.now().strftime(TIME_FORMAT)
+        try:
+            self.db_querymany("UPDATE Bans SET active=0 WHERE name=? AND active=1 AND expires<=?",
+                *[(name, now) for name in names])
+            self.db_commit()
+        finally:
+            # We're on the timer's thread, so close the connection it opened.
+            self.db_close()
     
     def get_profile_thread(self, player, days):
         try:
@@ -19,6 +19,7 @@
 #Some essential functions.
 
 import minqlbot
+import plugins.teamstate as teamstate
 import plugins
 import datetime
 import re
@@ -29,6 +30,7 @@ TIME_FORMAT = "%H:%M:%S"
 class essentials(minqlbot.Plugin):
     def __init__(self):
         super().__init__()
+        teamstate.track(self)
         self.add_hook("player_connect", self.handle_player_connect)
         self.add_hook("player_disconnect", self.handle_player_disconnect)
         self.add_hook("bot_connect", self.handle_bot_connect)
@@ -74,7 +76,7 @@ class essentials(minqlbot.Plugin):
         """When we connect to a server with players, update 'last_seen' of all players.
 
         """
-        for player in self.players():
+        for player in teamstate.tracker.all_players(self):
             self.update_player(player)
 
     def handle_vote_called(self, caller, vote, args):
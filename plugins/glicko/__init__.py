@@ -0,0 +1 @@
+from plugins.glicko.glicko import DEFAULT_RATING, DEFAULT_DEVIATION, inflate, rate_teams
@@ -0,0 +1,86 @@
+# minqlbot - A Quake Live server administrator bot.
+# Copyright (C) 2015 Mino <mino@minomino.org>
+
+# This file is part of minqlbot.
+
+# minqlbot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# minqlbot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with minqlbot. If not, see <http://www.gnu.org/licenses/>.
+
+"""Glicko ratings for team games, worked out from nothing but who won.
+
+Everyone starts out at DEFAULT_RATING with a large deviation, meaning we have little
+idea how good they are. Every game rates each player against a single opponent made up
+of the other team, with the team's average rating and a deviation combining theirs.
+The better we know a player, the smaller their deviation and the less a single game
+moves them. A player that hasn't played in a while has their deviation grow again,
+since they could've gotten better or worse in the meantime.
+
+See http://www.glicko.net/glicko/glicko.pdf for the details.
+
+"""
+
+import math
+
+DEFAULT_RATING = 1500
+DEFAULT_DEVIATION = 350
+# Keep the deviation from going below this, or regulars would stop moving at all.
+MIN_DEVIATION = 30
+# How much the deviation grows per day of not playing. Takes a regular back up to
+# DEFAULT_DEVIATION after about 100 days.
+INACTIVITY = 34.6
+
+Q = math.log(10) / 400
+
+def g(deviation):
+    """Weight an opponent's rating by how sure we are of it."""
+    return 1 / math.sqrt(1 + 3 * Q ** 2 * deviation ** 2 / math.pi ** 2)
+
+def expected(rating, opponent, opponent_deviation):
+    """The expected score against an opponent, from 0 to 1."""
+    return 1 / (1 + 10 ** (-g(opponent_deviation) * (rating - opponent) / 400))
+
+def inflate(deviation, days):
+    """The deviation of a player that hasn't played for a number of days."""
+    return min(math.sqrt(deviation ** 2 + INACTIVITY ** 2 * max(days, 0)), DEFAULT_DEVIATION)
+
+def update(rating, deviation, opponent, opponent_deviation, score):
+    """Rate a player after a game against an opponent. The score is 1 for a win,
+    0 for a loss and 0.5 for a draw. Returns a tuple (rating, deviation).
+
+    """
+    weight = g(opponent_deviation)
+    e = expected(rating, opponent, opponent_deviation)
+    d2_inv = Q ** 2 * weight ** 2 * e * (1 - e)
+    precision = 1 / deviation ** 2 + d2_inv
+    rating += Q / precision * weight * (score - e)
+    deviation = max(math.sqrt(1 / precision), MIN_DEVIATION)
+    return rating, deviation
+
+def team_opponent(team):
+    """Turn a team of (rating, deviation) tuples into a single opponent."""
+    rating = sum(r for r, d in team) / len(team)
+    deviation = math.sqrt(sum(d ** 2 for r, d in team) / len(team))
+    return rating, deviation
+
+def rate_teams(red, blue, score):
+    """Rate everyone after a game between two teams of (rating, deviation) tuples. The
+    score is red's, so 1 if red won, 0 if blue did and 0.5 for a draw.
+
+    Returns a tuple (red, blue) with the new ratings in the same order.
+
+    """
+    red_opponent = team_opponent(red)
+    blue_opponent = team_opponent(blue)
+    new_red = [update(r, d, blue_opponent[0], blue_opponent[1], score) for r, d in red]
+    new_blue = [update(r, d, red_opponent[0], red_opponent[1], 1 - score) for r, d in blue]
+    return new_red, new_blue
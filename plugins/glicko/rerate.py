@@ -0,0 +1,198 @@
+# minqlbot - A Quake Live server administrator bot.
+# Copyright (C) 2015 Mino <mino@minomino.org>
+
+# This file is part of minqlbot.
+
+# minqlbot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# minqlbot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with minqlbot. If not, see <http://www.gnu.org/licenses/>.
+
+"""Recompute every Glicko rating from scratch by replaying all saved games.
+
+Meant to be run by hand after changing how ratings are worked out, from the folder
+the plugins folder is in:
+
+    python -m plugins.glicko.rerate minqlbot.db --inactivity 30
+
+Instead of going through the games one at a time, they're split into levels where
+every game only depends on games in earlier levels, that is, the players of a game
+have all played their previous game in an earlier level. Every game in a level can
+then be rated at the same time with NumPy, and the result is written back to
+GlickoRatings in a single transaction.
+
+"""
+
+import argparse
+import datetime
+import math
+import sqlite3
+import sys
+
+from plugins.glicko.glicko import DEFAULT_RATING, DEFAULT_DEVIATION, MIN_DEVIATION, INACTIVITY, Q
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+def levels(games):
+    """Group the indices of games so that each group only depends on earlier ones.
+    Games are (finished, score, red, blue) tuples where red and blue are lists of
+    player IDs, in the order they were played.
+
+    """
+    last = {}
+    res = []
+    for i, (finished, score, red, blue) in enumerate(games):
+        level = 1 + max((last.get(p, -1) for p in red + blue), default=-1)
+        if level == len(res):
+            res.append([])
+        res[level].append(i)
+        for p in red + blue:
+            last[p] = level
+    return res
+
+def replay(games, players, rating=DEFAULT_RATING, deviation=DEFAULT_DEVIATION,
+           min_deviation=MIN_DEVIATION, inactivity=INACTIVITY):
+    """Rate everyone by replaying games, as returned by load_games(), for a number
+    of players. Does the same as glicko.rate_teams() with the inactivity in between
+    as done by the balance plugin, but for a whole level of games at a time.
+
+    Returns a tuple of arrays (ratings, deviations, games, last_played) indexed by player ID.
+
+    """
+    ratings = numpy.full(players, float(rating))
+    deviations = numpy.full(players, float(deviation))
+    played = numpy.zeros(players, dtype=numpy.int64)
+    last = numpy.zeros(players)
+
+    for level in levels(games):
+        ids = []
+        keys = []
+        times = []
+        scores = []
+        for n, i in enumerate(level):
+            finished, score, red, blue = games[i]
+            ids += red + blue
+            keys += [2 * n] * len(red) + [2 * n + 1] * len(blue)
+            times += [finished] * (len(red) + len(blue))
+            scores += [score] * len(red) + [1 - score] * len(blue)
+        ids = numpy.array(ids, dtype=numpy.int64)
+        keys = numpy.array(keys, dtype=numpy.int64)
+        times = numpy.array(times)
+        scores = numpy.array(scores)
+
+        r = ratings[ids]
+        d = deviations[ids]
+        # Deviations grow for every day a player hasn't played, but only if they have played before.
+        days = numpy.maximum(times - last[ids], 0) / 86400
+        d = numpy.where(played[ids] > 0, numpy.minimum(numpy.sqrt(d ** 2 + inactivity ** 2 * days), deviation), d)
+
+        # Every team as a single opponent for the other one.
+        counts = numpy.bincount(keys, minlength=2 * len(level))
+        team_rating = numpy.bincount(keys, weights=r, minlength=2 * len(level)) / counts
+        team_deviation = numpy.sqrt(numpy.bincount(keys, weights=d ** 2, minlength=2 * len(level)) / counts)
+        opponent = keys ^ 1
+        opponent_rating = team_rating[opponent]
+        weight = 1 / numpy.sqrt(1 + 3 * Q ** 2 * team_deviation[opponent] ** 2 / math.pi ** 2)
+
+        e = 1 / (1 + 10 ** (-weight * (r - opponent_rating) / 400))
+        precision = 1 / d ** 2 + Q ** 2 * weight ** 2 * e * (1 - e)
+        ratings[ids] = r + Q / precision * weight * (scores - e)
+        deviations[ids] = numpy.maximum(numpy.sqrt(1 / precision), min_deviation)
+        played[ids] += 1
+        last[ids] = times
+
+    return ratings, deviations, played, last
+
+def load_games(db, game_types=None):
+    """Load all saved team games in the order they were played.
+
+    Returns a tuple (games, keys) where games is a list of (finished, score, red, blue)
+    tuples and keys the (name, game_type) of each player ID.
+
+    """
+    ids = {}
+    games = {}
+    query = ("SELECT g.id, g.game_type, g.winner, g.finished, p.name, p.team FROM Games g "
+             "JOIN GamePlayers p ON p.game_id = g.id")
+    args = ()
+    if game_types:
+        query += " WHERE g.game_type IN ({})".format(", ".join("?" * len(game_types)))
+        args = tuple(game_types)
+    query += " ORDER BY g.finished, g.id"
+
+    for game_id, game_type, winner, finished, name, team in db.execute(query, args):
+        if game_id not in games:
+            finished = datetime.datetime.strptime(finished, TIME_FORMAT).timestamp()
+            score = {"red": 1, "blue": 0}.get(winner, 0.5)
+            games[game_id] = (finished, score, [], [])
+        key = (name, game_type)
+        if key not in ids:
+            ids[key] = len(ids)
+        games[game_id][2 if team == "red" else 3].append(ids[key])
+
+    # Insertion order is the order they were played in.
+    games = [g for g in games.values() if g[2] and g[3]]
+    keys = [None] * len(ids)
+    for key, i in ids.items():
+        keys[i] = key
+    return games, keys
+
+def rerate(path, game_types=None, **kwargs):
+    """Replay every game in a database and replace its Glicko ratings with the result.
+    Returns the number of games replayed and players rated.
+
+    """
+    db = sqlite3.connect(path)
+    try:
+        games, keys = load_games(db, game_types)
+        ratings, deviations, played, last = replay(games, len(keys), **kwargs)
+        rows = [(name, game_type, float(ratings[i]), float(deviations[i]), int(played[i]),
+                 datetime.datetime.fromtimestamp(last[i]).strftime(TIME_FORMAT))
+                for i, (name, game_type) in enumerate(keys)]
+        with db:
+            if game_types:
+                db.execute("DELETE FROM GlickoRatings WHERE game_type IN ({})"
+                           .format(", ".join("?" * len(game_types))), tuple(game_types))
+            else:
+                db.execute("DELETE FROM GlickoRatings")
+            db.executemany("INSERT INTO GlickoRatings VALUES(?, ?, ?, ?, ?, ?)", rows)
+    finally:
+        db.close()
+
+    return len(games), len(rows)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Recompute Glicko ratings from all saved games.")
+    parser.add_argument("database", help="path to minqlbot.db")
+    parser.add_argument("-g", "--game-type", action="append", dest="game_types",
+                        help="only replay this game type, can be given more than once")
+    parser.add_argument("--rating", type=float, default=DEFAULT_RATING, help="rating of new players")
+    parser.add_argument("--deviation", type=float, default=DEFAULT_DEVIATION,
+                        help="deviation of new players, and the most it can grow to")
+    parser.add_argument("--min-deviation", type=float, default=MIN_DEVIATION, help="the lowest the deviation can go")
+    parser.add_argument("--inactivity", type=float, default=INACTIVITY,
+                        help="how much the deviation grows per day of not playing")
+    args = parser.parse_args(argv)
+
+    if numpy is None:
+        sys.exit("The re-rater needs NumPy. Install it with: pip install numpy")
+
+    games, players = rerate(args.database, args.game_types, rating=args.rating, deviation=args.deviation,
+                            min_deviation=args.min_deviation, inactivity=args.inactivity)
+    print("Replayed {} games and rated {} players.".format(games, players))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1 @@
+from plugins.httppool.httppool import ConnectionPool, Response, get_pool
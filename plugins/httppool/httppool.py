@@ -0,0 +1,132 @@
+# minqlbot - A Quake Live server administrator bot.
+# Copyright (C) 2015 Mino <mino@minomino.org>
+
+# This file is part of minqlbot.
+
+# minqlbot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# minqlbot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with minqlbot. If not, see <http://www.gnu.org/licenses/>.
+
+"""Persistent HTTP connections shared by everything that talks to the same host.
+
+Opening a new connection for every QLRanks lookup or profile check means paying for
+the TCP handshake each time, and the old connections were never closed either. Instead,
+connections are handed back to a small per-host pool after each request and reused
+until they've been idle for too long.
+
+"""
+
+import http.client
+import socket
+import threading
+import time
+
+# Errors that could mean a kept-alive connection was closed on the other end while idle.
+# Timeouts are not among them, since trying again would just double the wait.
+STALE_ERRORS = (OSError, http.client.HTTPException)
+
+class Response():
+    def __init__(self, status, reason, headers, data, elapsed):
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.data = data
+        # How long the request took in seconds, from sending it to having read the body.
+        self.elapsed = elapsed
+
+class ConnectionPool():
+    def __init__(self, host, secure=False, max_size=4, idle_timeout=30, timeout=10):
+        self.host = host
+        self.secure = secure
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        # Items: (connection, time it was put back)
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def request(self, method, path, body=None, headers={}):
+        """Send a request and read the whole response, reusing an idle connection if
+        there is one. If a reused connection turns out to have been closed, the request
+        is retried once on a new one.
+
+        """
+        conn, reused = self.acquire()
+        start = time.perf_counter()
+        try:
+            response = self.send(conn, method, path, body, headers)
+        except STALE_ERRORS as e:
+            conn.close()
+            if not reused or isinstance(e, socket.timeout):
+                raise
+            conn = self.connect()
+            start = time.perf_counter()
+            try:
+                response = self.send(conn, method, path, body, headers)
+            except:
+                conn.close()
+                raise
+        except:
+            conn.close()
+            raise
+
+        elapsed = time.perf_counter() - start
+        if response.will_close:
+            conn.close()
+        else:
+            self.release(conn)
+
+        return Response(response.status, response.reason, response.getheaders(), response.data, elapsed)
+
+    def send(self, conn, method, path, body, headers):
+        conn.request(method, path, body, headers)
+        response = conn.getresponse()
+        # The body has to be read in full before the connection can be used again.
+        response.data = response.read()
+        return response
+
+    def acquire(self):
+        now = time.time()
+        with self.lock:
+            while self.idle:
+                conn, released = self.idle.pop()
+                if now - released < self.idle_timeout:
+                    return conn, True
+                conn.close()
+
+        return self.connect(), False
+
+    def release(self, conn):
+        with self.lock:
+            if len(self.idle) < self.max_size:
+                self.idle.append((conn, time.time()))
+                return
+
+        conn.close()
+
+    def connect(self):
+        if self.secure:
+            return http.client.HTTPSConnection(self.host, timeout=self.timeout)
+        else:
+            return http.client.HTTPConnection(self.host, timeout=self.timeout)
+
+pools = {}
+pools_lock = threading.Lock()
+
+def get_pool(host, secure=False):
+    """Get the shared pool for a host, creating it if needed.
+
+    """
+    with pools_lock:
+        if (host, secure) not in pools:
+            pools[(host, secure)] = ConnectionPool(host, secure)
+        return pools[(host, secure)]
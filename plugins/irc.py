@@ -21,6 +21,7 @@ import asynchat
 import asyncore
 import re
 import minqlbot
+import plugins.teamstate as teamstate
 import traceback
 
 from threading import Thread
@@ -48,6 +49,7 @@ COLORS = ("\x0301", "\x0304", "\x0303", "\x0308", "\x0302", "\x0311", "\x0306",
 class irc(minqlbot.Plugin):
     def __init__(self):
         super().__init__()
+        teamstate.track(self)
         self.add_hook("unload", self.handle_unload)
         self.add_hook("chat", self.handle_game_chat)
         self.add_hook("player_connect", self.handle_player_connect)
@@ -107,7 +109,7 @@ class irc(minqlbot.Plugin):
             self.msg("^6<^7{}^6> ^5{}".format(user, " ".join(split_msg[1:])), "team_chat")
         # .players - List players currently on the server.
         elif split_msg[0] == ".players":
-                teams = self.teams()
+                teams = teamstate.tracker.teams(self)
                 game = self.game()
                 # Make a list of players.
                 plist = ""
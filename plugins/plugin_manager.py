@@ -67,6 +67,8 @@ class plugin_manager(minqlbot.Plugin):
     def cmd_reload_config(self, player, msg, channel):
         try:
             minqlbot.reload_config()
+            if "balance" in self.plugins:
+                self.plugins["balance"].config_reloaded()
             channel.reply("^7The config file was reloaded successfully.")
         except:
             channel.reply("^7The config file has failed to reload.")
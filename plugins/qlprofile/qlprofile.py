@@ -19,12 +19,17 @@
 import urllib.parse
 import urllib.request
 import urllib.error
+import http.client
 import http.cookiejar
 import datetime
+import plugins.httppool as httppool
 
 from html.parser import HTMLParser
 
 QL_URL = "http://quakelive.com/"
+USER_AGENT = "Mozilla/5.0 (compatible; MSIE 9.0; Windows NT 6.1; WOW64; Trident/5.0)"
+# How many redirects to follow before giving up.
+MAX_REDIRECTS = 3
 
 class QlProfileParser(HTMLParser):
     def __init__(self, strict=False):
@@ -145,17 +150,50 @@ class QlProfile():
         return (self.get_date() < min)
 
 def get_profile(name):
-    cookies = http.cookiejar.CookieJar(http.cookiejar.DefaultCookiePolicy())
-    opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(cookies))
     url = QL_URL + "profile/summary/" + name.lower()
-    request = urllib.request.Request(url, 
-        headers={"User-Agent": "Mozilla/5.0 (compatible; MSIE 9.0; Windows NT 6.1; WOW64; Trident/5.0)"})
-    res = opener.open(request)
-    data = res.read()
+    data = get_page(url)
     parser = QlProfileParser()
     parser.feed(data.decode())
     return parser.profile
 
+class CookieResponse():
+    """Just enough of a urllib response for CookieJar.extract_cookies() to work with."""
+    def __init__(self, headers):
+        self.headers = http.client.HTTPMessage()
+        for name, value in headers:
+            self.headers[name] = value
+
+    def info(self):
+        return self.headers
+
+def get_page(url):
+    """GET a page through the shared connection pools, following redirects. Cookies set
+    along the way are sent with the requests that follow, like a browser would.
+
+    """
+    cookies = http.cookiejar.CookieJar()
+    for i in range(MAX_REDIRECTS + 1):
+        request = urllib.request.Request(url, headers={"User-Agent": USER_AGENT})
+        cookies.add_cookie_header(request)
+        parsed = urllib.parse.urlsplit(url)
+        pool = httppool.get_pool(parsed.netloc, secure=(parsed.scheme == "https"))
+        path = parsed.path or "/"
+        if parsed.query:
+            path += "?" + parsed.query
+        response = pool.request("GET", path, headers=dict(request.header_items()))
+        cookies.extract_cookies(CookieResponse(response.headers), request)
+        if response.status in (301, 302, 303, 307, 308):
+            location = dict((k.lower(), v) for k, v in response.headers).get("location")
+            if not location:
+                break
+            url = urllib.parse.urljoin(url, location)
+            continue
+        elif response.status != http.client.OK:
+            raise urllib.error.HTTPError(url, response.status, response.reason, None, None)
+        return response.data
+
+    raise urllib.error.HTTPError(url, response.status, "Too many redirects.", None, None)
+
 if __name__ == "__main__":
     profile = get_profile("Mino")
     
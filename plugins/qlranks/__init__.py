@@ -1 +1 @@
-from plugins.qlranks.qlranks import QlRanks
+from plugins.qlranks.qlranks import QlRanks, CircuitBreaker, breaker
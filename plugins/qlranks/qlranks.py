@@ -18,9 +18,84 @@
 
 import http.client
 import json
+import random
 import threading
+import time
 import minqlbot
 import traceback
+import plugins.httppool as httppool
+
+class CircuitBreaker():
+    """Keeps track of whether QLRanks is up, so we don't keep waiting on it when it's not.
+
+    Starts out closed, letting every request through. After enough failures in a row it
+    opens, and requests are refused until the backoff is over. It then goes half-open and
+    lets a single request through to test the waters. If that one succeeds, it closes again,
+    and if not, it opens again with twice the backoff, up to a maximum. The backoff gets a bit
+    of jitter so that we don't end up retrying in lockstep with anything else.
+
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, failures_allowed=2, backoff=5, max_backoff=300, jitter=0.2):
+        self.failures_allowed = failures_allowed
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.state = self.CLOSED
+        self.failures = 0
+        # How many times in a row we've opened, for the exponential backoff.
+        self.trips = 0
+        self.retry_at = 0
+        self.lock = threading.Lock()
+
+    def allow(self):
+        """Check if a request should be sent. In the half-open state, only the first
+        caller gets a yes until we know how it went.
+
+        """
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            elif self.state == self.OPEN and time.time() >= self.retry_at:
+                self.state = self.HALF_OPEN
+                return True
+            else:
+                return False
+
+    def success(self):
+        with self.lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self.trips = 0
+
+    def failure(self):
+        with self.lock:
+            # Lookups that were already on their way when we opened don't tell us
+            # anything new, so they shouldn't make the backoff any longer.
+            if self.state == self.OPEN:
+                return
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failures_allowed:
+                backoff = min(self.max_backoff, self.backoff * 2 ** self.trips)
+                backoff *= random.uniform(1 - self.jitter, 1 + self.jitter)
+                self.state = self.OPEN
+                self.retry_at = time.time() + backoff
+                self.trips += 1
+
+    def retry_in(self):
+        """Seconds left until requests are let through again.
+
+        """
+        with self.lock:
+            if self.state != self.OPEN:
+                return 0
+            return max(0, self.retry_at - time.time())
+
+# Shared by every lookup, so it outlives plugin reloads.
+breaker = CircuitBreaker()
 
 class QlRanks(threading.Thread):
     instances = 0
@@ -33,6 +108,10 @@ class QlRanks(threading.Thread):
         self.status = 0
         self.check_alias = check_alias
         self.aliases = {}
+        # How long the request took in seconds.
+        self.elapsed = 0
+        # Whether the breaker has been told how this lookup went.
+        self.reported = False
         QlRanks.instances += 1
     
     def run(self):
@@ -50,15 +129,21 @@ class QlRanks(threading.Thread):
             try:
                 player_list = "+".join(self.players)
                 data = self.get_data("www.qlranks.com", "/api.aspx?nick={}".format(player_list))
+                self.plugin.debug("QLRanks thread #{} got a response in {} ms."
+                    .format(self.uid, round(self.elapsed * 1000)))
             except:
                 self.status = -2
+                self.report(False)
                 self.plugin.cache_players(None, self)
-                self.plugin.execute_pending() # execute_pending has endless loop prevention.
                 return
 
-            if "players" not in data:
-                raise Exception("QLRanks returned a valid, but unexpected JSON response.")
-
+            if not data or "players" not in data:
+                self.report(False)
+                if data:
+                    raise Exception("QLRanks returned a valid, but unexpected JSON response.")
+                self.plugin.cache_players(None, self)
+                return
+            self.report(True)
 
             if self.check_alias:
                 # Replace alias nicknames with real names.
@@ -69,30 +154,38 @@ class QlRanks(threading.Thread):
                         player["alias_of"] = name
                         del self.aliases[name]
 
+            # Caching the players also runs whatever was waiting for them.
             self.plugin.cache_players(data, self)
-            # Check for pending teams info/balancing needed. Execute if so.
-            self.plugin.execute_pending()
         except:
             self.status = -3
             e = traceback.format_exc().rstrip("\n")
             minqlbot.debug("========== ERROR: QLRanks Fetcher #{} ==========".format(self.uid))
             for line in e.split("\n"):
                 minqlbot.debug(line)
+            # If this was the half-open probe, the breaker would wait on it forever otherwise.
+            if not self.reported:
+                self.report(False)
             self.plugin.cache_players(None, self)
-            self.plugin.execute_pending()
+
+    def report(self, ok):
+        self.reported = True
+        if ok:
+            breaker.success()
+        else:
+            breaker.failure()
     
     def get_data(self, url, path, post_data=None, headers={}):
-        c = http.client.HTTPConnection(url, timeout=10)
+        pool = httppool.get_pool(url)
         if post_data:
-            c.request("POST", path, post_data, headers)
+            response = pool.request("POST", path, post_data, headers)
         else:
-            c.request("GET", path, headers=headers)
-        response = c.getresponse()
+            response = pool.request("GET", path, headers=headers)
         self.status = response.status
+        self.elapsed = response.elapsed
         
         if response.status == http.client.OK: # 200
             try:
-                data = json.loads(response.read().decode())
+                data = json.loads(response.data.decode())
                 return data
             except:
                 self.status = -1
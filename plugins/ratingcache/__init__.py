@@ -0,0 +1 @@
+from plugins.ratingcache.ratingcache import RatingCache
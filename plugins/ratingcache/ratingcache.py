@@ -0,0 +1,293 @@
+# minqlbot - A Quake Live server administrator bot.
+# Copyright (C) 2015 Mino <mino@minomino.org>
+
+# This file is part of minqlbot.
+
+# minqlbot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# minqlbot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with minqlbot. If not, see <http://www.gnu.org/licenses/>.
+
+import array
+import collections
+import threading
+import time
+
+# Never go below this, or a big enough lobby could evict its own players mid-balance.
+MINIMUM_SIZE = 64
+# Game types that get a slot up front. Any other game type gets one the first time it's used.
+GAME_TYPES = ("ca", "ffa", "ctf", "duel", "tdm")
+
+class Rating():
+    """A player's rating in a game type. If it's been clipped by the floor or ceiling,
+    elo is the clipped rating and real_elo the actual one. Otherwise real_elo is None.
+
+    """
+    __slots__ = ("elo", "rank", "real_elo")
+
+    def __init__(self, elo, rank, real_elo=None):
+        self.elo = elo
+        self.rank = rank
+        self.real_elo = real_elo
+
+class Slot():
+    """The ratings of every player in a single game type, indexed by player ID.
+
+    An expiry time of 0 means the player has no rating in the game type.
+
+    """
+    __slots__ = ("elo", "rank", "expires")
+
+    def __init__(self, size):
+        self.elo = array.array("i", bytes(4 * size))
+        self.rank = array.array("i", bytes(4 * size))
+        self.expires = array.array("d", bytes(8 * size))
+
+    def grow(self, size):
+        extra = size - len(self.elo)
+        self.elo.frombytes(bytes(4 * extra))
+        self.rank.frombytes(bytes(4 * extra))
+        self.expires.frombytes(bytes(8 * extra))
+
+class RatingCache():
+    """A bounded cache of player ratings, evicting the least recently used players.
+
+    Player names are interned to small integer IDs, and each game type is a slot of arrays
+    indexed by those IDs, so a player costs a few bytes per game type instead of a couple
+    of dicts. Ratings are stored as they are, and clipped to the floor and ceiling when
+    read, so changing those in the config takes effect right away.
+
+    Every game type of every player has its own expiry time, and ratings QLRanks has no
+    data on (rank 0) expire sooner so that we eventually check again, but not on every
+    single connect.
+
+    Expired ratings can still be used for stale_ttl seconds after they expire. They're
+    noted down when that happens, so that they can be fetched again in the background
+    with pop_stale() while nobody has to wait for it.
+
+    The version goes up every time a rating is set or removed, or the floor or ceiling
+    change, so anything worked out from the ratings can tell if it's outdated.
+
+    """
+    def __init__(self, max_size=2000, ttl=86400, no_data_ttl=7200, floor=0, ceiling=0, stale_ttl=0):
+        # Keys: player_name - Items: player ID
+        self.ids = {}
+        # Indexed by player ID.
+        self.names = []
+        self.aliases = []
+        # IDs of evicted players that can be given to new ones.
+        self.free = []
+        self.capacity = 0
+        # Keys: game_type - Items: Slot()
+        self.slots = {}
+        # Player IDs from least to most recently used.
+        self.lru = collections.OrderedDict()
+        self.lock = threading.RLock()
+        self.version = 0
+        # Items: (player_name, game_type) of stale ratings that have been used.
+        self.stale = set()
+        # Set by configure().
+        self.floor = None
+        self.ceiling = None
+        for game_type in GAME_TYPES:
+            self.slots[game_type] = Slot(self.capacity)
+        self.configure(max_size, ttl, no_data_ttl, floor, ceiling, stale_ttl)
+
+    def configure(self, max_size, ttl, no_data_ttl, floor=0, ceiling=0, stale_ttl=0):
+        with self.lock:
+            self.max_size = max(max_size, MINIMUM_SIZE)
+            self.ttl = ttl
+            self.no_data_ttl = no_data_ttl
+            self.stale_ttl = stale_ttl
+            # Nothing else changes what ratings() returns, unless someone's evicted.
+            if (floor, ceiling) != (self.floor, self.ceiling):
+                self.floor = floor
+                self.ceiling = ceiling
+                self.version += 1
+            self.evict()
+
+    def __contains__(self, name):
+        with self.lock:
+            return name in self.ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def clip(self, elo):
+        if self.floor and elo < self.floor:
+            return self.floor
+        elif self.ceiling and elo > self.ceiling:
+            return self.ceiling
+        return elo
+
+    def has(self, name, game_type, stale=True):
+        return self.get(name, game_type, stale) is not None
+
+    def get(self, name, game_type, stale=True):
+        """Get the Rating of a player in a game type, or None if it's not cached or expired.
+        Unless stale is False, expired ratings are still returned for a while and noted
+        down as needing a refresh.
+
+        """
+        with self.lock:
+            uid = self.ids.get(name)
+            slot = self.slots.get(game_type)
+            if uid is None or slot is None or not slot.expires[uid]:
+                return None
+
+            expires = slot.expires[uid]
+            now = time.time()
+            if expires + self.stale_ttl <= now:
+                slot.expires[uid] = 0
+                return None
+            elif expires <= now:
+                if not stale:
+                    return None
+                self.stale.add((name, game_type))
+
+            self.lru.move_to_end(uid)
+            elo = slot.elo[uid]
+            clipped = self.clip(elo)
+            if clipped != elo:
+                return Rating(clipped, slot.rank[uid], elo)
+            return Rating(elo, slot.rank[uid])
+
+    def pop_stale(self):
+        """Get the (name, game_type) of every stale rating used since last time.
+
+        """
+        with self.lock:
+            stale = self.stale
+            self.stale = set()
+            return stale
+
+    def rating(self, name, game_type):
+        """Get the rating a player should be treated as, after clipping.
+
+        """
+        rating = self.get(name, game_type)
+        return rating.elo if rating else None
+
+    def ratings(self, names, game_type):
+        """Get the clipped ratings of several players, in the same order. Unlike get(),
+        this assumes they're all cached and doesn't check expiry times, so that a player
+        expiring halfway through a balance doesn't blow up in our face. A player with no
+        rating in the game type at all is a KeyError, same as one that isn't cached.
+
+        """
+        with self.lock:
+            slot = self.slots[game_type]
+            ids = self.ids
+            res = []
+            for name in names:
+                uid = ids[name]
+                if not slot.expires[uid]:
+                    raise KeyError(name)
+                res.append(slot.elo[uid])
+            if self.floor or self.ceiling:
+                res = [self.clip(elo) for elo in res]
+            return res
+
+    def set(self, name, game_type, elo, rank, fetched=None):
+        if fetched is None:
+            fetched = time.time()
+
+        if rank == 0:
+            expires = fetched + self.no_data_ttl
+        else:
+            expires = fetched + self.ttl
+
+        with self.lock:
+            uid = self.intern(name)
+            slot = self.slot(game_type)
+            slot.elo[uid] = int(elo)
+            slot.rank[uid] = rank
+            slot.expires[uid] = expires
+            self.lru.move_to_end(uid)
+            self.version += 1
+            self.evict()
+
+    def alias_of(self, name):
+        with self.lock:
+            uid = self.ids.get(name)
+            return None if uid is None else self.aliases[uid]
+
+    def set_alias(self, name, real_name):
+        with self.lock:
+            self.aliases[self.intern(name)] = real_name
+            self.evict()
+
+    def remove(self, name, game_type=None):
+        """Remove a player, or just one of the game types if one is passed.
+
+        """
+        with self.lock:
+            uid = self.ids.get(name)
+            if uid is None:
+                return False
+            elif game_type is None:
+                self.release(uid)
+                return True
+            elif game_type in self.slots and self.slots[game_type].expires[uid]:
+                self.slots[game_type].expires[uid] = 0
+                self.version += 1
+                return True
+            else:
+                return False
+
+    def intern(self, name):
+        """Get the ID of a player, giving them one if they don't have one already.
+
+        """
+        uid = self.ids.get(name)
+        if uid is not None:
+            return uid
+
+        if self.free:
+            uid = self.free.pop()
+            self.names[uid] = name
+            self.aliases[uid] = None
+        else:
+            uid = len(self.names)
+            self.names.append(name)
+            self.aliases.append(None)
+            if uid >= self.capacity:
+                self.capacity = max(MINIMUM_SIZE, self.capacity * 2)
+                for slot in self.slots.values():
+                    slot.grow(self.capacity)
+
+        self.ids[name] = uid
+        self.lru[uid] = None
+        return uid
+
+    def release(self, uid):
+        # Clear the ratings too, so that whoever gets the ID next doesn't inherit them.
+        for slot in self.slots.values():
+            slot.elo[uid] = 0
+            slot.rank[uid] = 0
+            slot.expires[uid] = 0
+        del self.ids[self.names[uid]]
+        del self.lru[uid]
+        self.names[uid] = None
+        self.aliases[uid] = None
+        self.free.append(uid)
+        self.version += 1
+
+    def slot(self, game_type):
+        if game_type not in self.slots:
+            self.slots[game_type] = Slot(self.capacity)
+        return self.slots[game_type]
+
+    def evict(self):
+        with self.lock:
+            while len(self.ids) > self.max_size:
+                uid = next(iter(self.lru))
+                self.release(uid)
@@ -0,0 +1 @@
+from plugins.ratingsketch.ratingsketch import RatingHistogram
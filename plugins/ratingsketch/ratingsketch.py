@@ -0,0 +1,103 @@
+# minqlbot - A Quake Live server administrator bot.
+# Copyright (C) 2015 Mino <mino@minomino.org>
+
+# This file is part of minqlbot.
+
+# minqlbot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# minqlbot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with minqlbot. If not, see <http://www.gnu.org/licenses/>.
+
+"""How many players there are at every rating, in a fixed number of buckets.
+
+Ratings only go so high, so instead of a general purpose quantile sketch we just
+count players in buckets of BUCKET_SIZE rating each. That's a couple of hundred
+counters per game type, and percentiles are accurate to within a bucket.
+
+"""
+
+import array
+
+BUCKET_SIZE = 25
+# Anything above this goes in the last bucket.
+MAX_RATING = 4000
+
+class RatingHistogram():
+    def __init__(self, bucket_size=BUCKET_SIZE, max_rating=MAX_RATING):
+        self.bucket_size = bucket_size
+        self.counts = array.array("q", bytes(8 * (max_rating // bucket_size + 1)))
+        self.total = 0
+
+    def bucket(self, rating):
+        return min(max(int(rating) // self.bucket_size, 0), len(self.counts) - 1)
+
+    def add(self, rating, count=1):
+        self.counts[self.bucket(rating)] += count
+        self.total += count
+
+    def remove(self, rating):
+        b = self.bucket(rating)
+        if self.counts[b]:
+            self.counts[b] -= 1
+            self.total -= 1
+
+    def set_bucket(self, bucket, count):
+        """Set the count of a bucket directly, like when loading it from the database."""
+        self.total += count - self.counts[bucket]
+        self.counts[bucket] = count
+
+    def percentile(self, rating, exclude=None):
+        """Get the percentage of players with a lower rating, assuming the ones in the
+        same bucket are spread out evenly. If the player we're asking about has been
+        counted, pass the rating they were counted with as exclude so they're not compared
+        against themselves. Returns None if there's nobody else to compare with.
+
+        """
+        total = self.total
+        counts = self.counts
+        if exclude is not None and counts[self.bucket(exclude)]:
+            counts = array.array(counts.typecode, counts)
+            counts[self.bucket(exclude)] -= 1
+            total -= 1
+        if not total:
+            return None
+        b = self.bucket(rating)
+        below = sum(counts[:b])
+        fraction = min(max((rating - b * self.bucket_size) / self.bucket_size, 0), 1)
+        return 100 * (below + counts[b] * fraction) / total
+
+    def quantile(self, q):
+        """Get the rating below which a fraction q of the players are."""
+        if not self.total:
+            return 0
+        target = q * self.total
+        seen = 0
+        for b, count in enumerate(self.counts):
+            if count and seen + count >= target:
+                return round((b + (target - seen) / count) * self.bucket_size)
+            seen += count
+        return len(self.counts) * self.bucket_size
+
+    def histogram(self, bins):
+        """Split the range of ratings we have players in into a number of bins of the same
+        size. Returns a list of (lowest, highest, count) tuples.
+
+        """
+        used = [b for b, count in enumerate(self.counts) if count]
+        if not used:
+            return []
+        first, last = used[0], used[-1] + 1
+        per_bin = max(-(-(last - first) // bins), 1)
+        res = []
+        for start in range(first, last, per_bin):
+            end = min(start + per_bin, last)
+            res.append((start * self.bucket_size, end * self.bucket_size - 1, sum(self.counts[start:end])))
+        return res
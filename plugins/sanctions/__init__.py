@@ -0,0 +1 @@
+from plugins.sanctions.sanctions import SanctionIndex, ExpiryScheduler
@@ -0,0 +1,164 @@
+# minqlbot - A Quake Live server administrator bot.
+# Copyright (C) 2015 Mino <mino@minomino.org>
+
+# This file is part of minqlbot.
+
+# minqlbot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# minqlbot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with minqlbot. If not, see <http://www.gnu.org/licenses/>.
+
+
+import datetime
+import heapq
+import threading
+import time
+
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+# Never sleep longer than this in one go, since timers can't wait for decades.
+MAX_WAIT = 86400
+
+def timestamp(expires):
+    """Turn an expiry date as stored in the database into seconds since the epoch."""
+    return datetime.datetime.strptime(expires, TIME_FORMAT).timestamp()
+
+class SanctionIndex():
+    """The active sanctions of one kind, like bans or silences, keyed by lowercase name.
+
+    This is loaded from the database once and kept up to date by the commands that change
+    it, so checking a player on connect is a dict lookup instead of a query that parses the
+    expiry date of every ban they've ever had. If a player somehow has more than one active
+    sanction, the one that lasts the longest is the one that counts.
+
+    Expiry timestamps are also kept in a heap, so that pop_expired() can tell what's
+    expired without looking at every sanction. Entries in there that have since been
+    replaced or removed are just skipped when they come up.
+
+    """
+    def __init__(self):
+        # Keys: name - Items: (expiry timestamp, expires, reason)
+        self.active = {}
+        # Items: (expiry timestamp, name)
+        self.expiries = []
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.active)
+
+    def load(self, rows):
+        """Replace everything with rows that have a name, expires and reason.
+
+        """
+        now = time.time()
+        with self.lock:
+            self.active.clear()
+            self.expiries.clear()
+            for row in rows:
+                expiry = timestamp(row["expires"])
+                if expiry > now:
+                    self.add(row["name"], row["expires"], row["reason"], expiry)
+
+    def add(self, name, expires, reason, expiry=None):
+        if expiry is None:
+            expiry = timestamp(expires)
+
+        with self.lock:
+            name = name.lower()
+            if name not in self.active or self.active[name][0] < expiry:
+                self.active[name] = (expiry, expires, reason)
+                heapq.heappush(self.expiries, (expiry, name))
+
+    def remove(self, name):
+        with self.lock:
+            return self.active.pop(name.lower(), None) is not None
+
+    def get(self, name):
+        """Get a tuple (expires, reason) if a player has an active sanction, or None.
+        Expired ones are left for pop_expired() to take care of.
+
+        """
+        with self.lock:
+            sanction = self.active.get(name.lower())
+            if sanction is None or sanction[0] <= time.time():
+                return None
+            return sanction[1], sanction[2]
+
+    def next_expiry(self):
+        """Get the timestamp of the next sanction to expire, or None if there are none.
+
+        """
+        with self.lock:
+            while self.expiries:
+                expiry, name = self.expiries[0]
+                if name in self.active and self.active[name][0] == expiry:
+                    return expiry
+                heapq.heappop(self.expiries)
+            return None
+
+    def pop_expired(self):
+        """Remove the sanctions that have expired and get the names they were on.
+
+        """
+        now = time.time()
+        expired = []
+        with self.lock:
+            while self.expiries and self.expiries[0][0] <= now:
+                expiry, name = heapq.heappop(self.expiries)
+                if name in self.active and self.active[name][0] == expiry:
+                    del self.active[name]
+                    expired.append(name)
+        return expired
+
+class ExpiryScheduler():
+    """Sleeps until the next sanction in an index expires and then passes the names of
+    everyone whose sanction expired to a callback, on the timer's thread.
+
+    Call schedule() whenever a sanction is added, and cancel() when the plugin is unloaded.
+
+    """
+    def __init__(self, plugin, index, callback):
+        self.plugin = plugin
+        self.index = index
+        self.callback = callback
+        self.timer = None
+        # When the timer goes off, as a timestamp.
+        self.wakeup = None
+        self.cancelled = False
+        self.lock = threading.Lock()
+
+    def schedule(self):
+        expiry = self.index.next_expiry()
+        with self.lock:
+            if self.cancelled or expiry is None or (self.timer and self.wakeup <= expiry):
+                return
+            elif self.timer:
+                self.timer.cancel()
+
+            wait = min(max(expiry - time.time(), 0), MAX_WAIT)
+            self.wakeup = time.time() + wait
+            self.timer = self.plugin.delay(wait, self.run)
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+            if self.timer:
+                self.timer.cancel()
+                self.timer = None
+
+    def run(self):
+        with self.lock:
+            self.timer = None
+        try:
+            expired = self.index.pop_expired()
+            if expired:
+                self.callback(expired)
+        finally:
+            self.schedule()
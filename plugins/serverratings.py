@@ -19,10 +19,12 @@
 """Lists all the players in the game and their ratings. Needs the "balance" plugin to work. """
 
 import minqlbot
+import plugins.teamstate as teamstate
 
 class serverratings(minqlbot.Plugin):
     def __init__(self):
         super().__init__()
+        teamstate.track(self)
         self.add_command(("ratings", "elos", "selo"), self.cmd_ratings)
 
     def cmd_ratings(self, player, msg, channel):
@@ -30,35 +32,26 @@ class serverratings(minqlbot.Plugin):
         if "balance" not in self.plugins:
             return
 
-        teams = self.teams()
+        teams = teamstate.tracker.teams(self)
         teams = teams["red"] + teams["blue"]
         self.print_ratings(teams, channel, self.game().short_type)
 
     def print_ratings(self, names, channel, game_type):
         balance = self.plugins["balance"]
 
-        not_cached = balance.not_cached(game_type, names)
+        # Check whoever's playing now, since the lineup could've changed while we were waiting.
+        teams = teamstate.tracker.teams(self)
+        not_cached = balance.not_cached(game_type, teams["red"] + teams["blue"])
         if not_cached:
-            with balance.rlock:
-                for lookup in balance.lookups:
-                    for n in balance.lookups[lookup][1]:
-                        if n in not_cached:
-                            not_cached.remove(n)
-                if not_cached:
-                    balance.fetch_player_ratings(not_cached, channel, game_type)
-                if (self.print_ratings, (names, channel, game_type)) not in balance.pending:
-                    balance.pending.append((self.print_ratings, (names, channel, game_type)))
-                return False
-
-        teams = self.teams()
+            balance.wait_for_ratings(not_cached, channel, game_type, (self.print_ratings, (names, channel, game_type)))
+            return False
 
+        analysis = balance.analyze_teams(teams, game_type)
         if teams["red"]:
-            red_sorted = sorted(teams["red"], key=lambda x: balance.cache[x.clean_name.lower()][game_type]["elo"], reverse=True)
-            red = "^7" + ", ".join(["{}: ^1{}^7".format(p.clean_name, balance.cache[p.clean_name.lower()][game_type]["elo"]) for p in red_sorted])
+            red = "^7" + ", ".join(["{}: ^1{}^7".format(name, rating) for name, rating in analysis["red"]])
             channel.reply(red)
         if teams["blue"]:
-            blue_sorted = sorted(teams["blue"], key=lambda x: balance.cache[x.clean_name.lower()][game_type]["elo"], reverse=True)
-            blue = "^7" + ", ".join(["{}: ^4{}^7".format(p.clean_name, balance.cache[p.clean_name.lower()][game_type]["elo"]) for p in blue_sorted])
+            blue = "^7" + ", ".join(["{}: ^4{}^7".format(name, rating) for name, rating in analysis["blue"]])
             channel.reply(blue)
         
         return True
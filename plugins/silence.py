@@ -18,6 +18,7 @@
 
 import datetime
 import re
+import plugins.sanctions as sanctions
 import minqlbot
 
 LENGTH_REGEX = re.compile(r"(?P<number>[0-9]+) (?P<scale>seconds?|minutes?|hours?|days?|weeks?|months?|years?)")
@@ -27,8 +28,19 @@ DEFAULT_REASON = "Reason not specified."
 class silence(minqlbot.Plugin):
     def __init__(self):
         super().__init__()
+        # Active silences, so that checking players doesn't need the database. Any that ran
+        # out while we weren't running are marked inactive first.
+        now = datetime.datetime.now().strftime(TIME_FORMAT)
+        self.db_query("UPDATE Silences SET active=0 WHERE active=1 AND expires<=?", now)
+        self.db_commit()
+        self.silences = sanctions.SanctionIndex()
+        self.silences.load(self.db_query("SELECT name, expires, reason FROM Silences WHERE active=1"))
+        self.expiry = sanctions.ExpiryScheduler(self, self.silences, self.expire_silences)
+        self.expiry.schedule()
+
         self.add_hook("player_connect", self.handle_player_connect)
         self.add_hook("bot_connect", self.handle_bot_connect)
+        self.add_hook("unload", self.handle_unload)
         self.add_command("silence", self.cmd_silence, 1, usage="<full_name> <length> seconds|minutes|hours|days|... [reason]")
         self.add_command("unsilence", self.cmd_unsilence, 1, usage="<full_name>")
         self.add_command("checksilence", self.cmd_checksilence, usage="<full_name>")
@@ -48,6 +60,9 @@ class silence(minqlbot.Plugin):
             if self.is_silenced(player.name):
                 player.mute()
 
+    def handle_unload(self):
+        self.expiry.cancel()
+
     def cmd_silence(self, player, msg, channel):
         if len(msg) < 4:
             return minqlbot.RET_USAGE
@@ -93,6 +108,8 @@ class silence(minqlbot.Plugin):
             expires = (datetime.datetime.now() + td).strftime(TIME_FORMAT)
             self.db_query("INSERT INTO Silences VALUES(?, ?, ?, 1, ?)", name.lower(), now, expires, reason)
             self.db_commit()
+            self.silences.add(name, expires, reason)
+            self.expiry.schedule()
             self.mute(name)
             channel.reply("^6{} ^7has been silenced. The silence expires on ^6{}^7.".format(name, expires))
             return
@@ -110,6 +127,7 @@ class silence(minqlbot.Plugin):
                 self.db_commit()
                 unsilenced = True
         
+        self.silences.remove(name)
         if unsilenced:
             channel.reply("^6{}^7 has been unsilenced.".format(name))
         else:
@@ -133,12 +151,21 @@ class silence(minqlbot.Plugin):
     # ====================================================================
 
     def is_silenced(self, name):
-        clean = self.clean_name(name).lower()
-        c = self.db_query("SELECT * FROM Silences WHERE name=?", clean)
-        for row in c:
-            if clean == row["name"] and row["active"]:
-                expires = datetime.datetime.strptime(row["expires"], TIME_FORMAT)
-                if (expires - datetime.datetime.now()).total_seconds() > 0:
-                    return row["expires"], row["reason"]
-        return None
+        return self.silences.get(self.clean_name(name))
 
+    def expire_silences(self, names):
+        """Mark silences that have run out as inactive, all in one go, and unmute
+        whoever is still on the server.
+
+        """
+        now = datetime.datetime.now().strftime(TIME_FORMAT)
+        try:
+            self.db_querymany("UPDATE Silences SET active=0 WHERE name=? AND active=1 AND expires<=?",
+                *[(name, now) for name in names])
+            self.db_commit()
+        finally:
+            # We're on the timer's thread, so close the connection it opened.
+            self.db_close()
+        for name in names:
+            if self.player(name):
+                self.unmute(name)
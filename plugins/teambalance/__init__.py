@@ -0,0 +1 @@
+from plugins.teambalance.teambalance import SwapEvaluator, greedy_split, optimal_partition, optimal_split, plan_moves, win_probability
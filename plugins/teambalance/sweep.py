@@ -0,0 +1,166 @@
+# minqlbot - A Quake Live server administrator bot.
+# Copyright (C) 2015 Mino <mino@minomino.org>
+
+# This file is part of minqlbot.
+
+# minqlbot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# minqlbot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with minqlbot. If not, see <http://www.gnu.org/licenses/>.
+
+"""Try out different FloorRating, CeilingRating and MinimumSuggestionDifference values
+on games that have been played on the server.
+
+Meant to be run by hand from the folder the plugins folder is in:
+
+    python -m plugins.teambalance.sweep minqlbot.db --floor 0,800:1200:100 --ceiling 0,2000,2400
+
+Every combination is tried on every saved game where we know the rating everyone had
+going in. For each one we report how often the team with the higher average rating,
+after the floor and ceiling, actually won, how often !teams would've suggested a switch,
+and the average difference in actual rating between the teams after that switch. The
+combinations are spread across a pool of processes, one per core by default.
+
+"""
+
+import argparse
+import concurrent.futures
+import itertools
+import sqlite3
+
+from plugins.teambalance.teambalance import SwapEvaluator
+
+# The games to replay, set in every worker process by init_worker().
+lobbies = []
+
+def parse_values(s):
+    """Parse a comma separated list of values where each can also be a start:stop:step
+    range, with stop being included.
+
+    """
+    values = []
+    for part in s.split(","):
+        if ":" in part:
+            start, stop, step = (int(x) for x in part.split(":"))
+            values.extend(range(start, stop + 1, step))
+        else:
+            values.append(int(part))
+    return values
+
+def load_lobbies(path, game_types=None):
+    """Load the teams and winner of every saved game where we know everyone's rating.
+    Returns a list of (red, blue, winner) tuples, where red and blue are lists of ratings.
+
+    """
+    db = sqlite3.connect(path)
+    query = ("SELECT g.id, g.winner, p.team, p.rating FROM Games g "
+             "JOIN GamePlayers p ON p.game_id = g.id")
+    args = ()
+    if game_types:
+        query += " WHERE g.game_type IN ({})".format(", ".join("?" * len(game_types)))
+        args = tuple(game_types)
+    query += " ORDER BY g.id"
+
+    games = {}
+    unknown = set()
+    try:
+        for game_id, winner, team, rating in db.execute(query, args):
+            if rating is None:
+                unknown.add(game_id)
+                continue
+            game = games.setdefault(game_id, ([], [], winner))
+            game[0 if team == "red" else 1].append(rating)
+    finally:
+        db.close()
+
+    return [g for i, g in games.items() if i not in unknown and g[0] and g[1]]
+
+def clip(rating, floor, ceiling):
+    if floor and rating < floor:
+        return floor
+    elif ceiling and rating > ceiling:
+        return ceiling
+    return rating
+
+def evaluate(floor, ceiling, minimum_diff):
+    """Replay every lobby with one combination of values.
+
+    Returns a dict with the number of games the higher rated team won and lost, how many
+    times a switch would've been suggested, and the average difference after it.
+
+    """
+    res = {"floor": floor, "ceiling": ceiling, "minimum_diff": minimum_diff,
+           "right": 0, "wrong": 0, "suggested": 0, "diff": 0}
+    for red, blue, winner in lobbies:
+        clipped = SwapEvaluator([clip(r, floor, ceiling) for r in red], [clip(r, floor, ceiling) for r in blue])
+        avg_red, avg_blue = clipped.averages()
+        if winner in ("red", "blue") and avg_red != avg_blue:
+            if (avg_red > avg_blue) == (winner == "red"):
+                res["right"] += 1
+            else:
+                res["wrong"] += 1
+
+        actual = SwapEvaluator(red, blue)
+        # Only suggested with teams of the same size, just like !teams.
+        switch = clipped.best_swap() if len(red) == len(blue) else None
+        if switch and switch[2] >= minimum_diff:
+            res["suggested"] += 1
+            actual.swap(switch[0], switch[1])
+        res["diff"] += actual.difference()
+
+    if lobbies:
+        res["diff"] /= len(lobbies)
+    return res
+
+def init_worker(games):
+    global lobbies
+    lobbies = games
+
+def sweep(games, floors, ceilings, minimum_diffs, processes=None):
+    """Evaluate every combination of values in a pool of processes. Returns the results
+    in the same order as itertools.product(floors, ceilings, minimum_diffs).
+
+    """
+    grid = list(itertools.product(floors, ceilings, minimum_diffs))
+    with concurrent.futures.ProcessPoolExecutor(processes, initializer=init_worker, initargs=(games,)) as pool:
+        futures = [pool.submit(evaluate, *values) for values in grid]
+        return [f.result() for f in futures]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Try out balance settings on saved games.")
+    parser.add_argument("database", help="path to minqlbot.db")
+    parser.add_argument("-g", "--game-type", action="append", dest="game_types",
+                        help="only use this game type, can be given more than once")
+    parser.add_argument("--floor", type=parse_values, default=[0], help="FloorRating values to try")
+    parser.add_argument("--ceiling", type=parse_values, default=[0], help="CeilingRating values to try")
+    parser.add_argument("--min-diff", type=parse_values, default=[25],
+                        help="MinimumSuggestionDifference values to try")
+    parser.add_argument("-j", "--processes", type=int, default=None,
+                        help="number of processes to use, defaults to the number of cores")
+    args = parser.parse_args(argv)
+
+    games = load_lobbies(args.database, args.game_types)
+    if not games:
+        print("No games with known ratings to replay.")
+        return
+
+    results = sweep(games, args.floor, args.ceiling, args.min_diff, args.processes)
+    print("Replayed {} games.".format(len(games)))
+    print("{:>8} {:>8} {:>8} {:>9} {:>10} {:>9}".format("floor", "ceiling", "min_diff", "accuracy", "suggested", "avg_diff"))
+    # Best predictions first, and the most even teams among those.
+    for res in sorted(results, key=lambda r: (-r["right"] / max(r["right"] + r["wrong"], 1), r["diff"])):
+        decided = res["right"] + res["wrong"]
+        accuracy = res["right"] / decided if decided else 0
+        print("{:>8} {:>8} {:>8} {:>8.1%} {:>10} {:>9.1f}".format(res["floor"], res["ceiling"], res["minimum_diff"],
+                                                                 accuracy, res["suggested"], res["diff"]))
+
+if __name__ == "__main__":
+    main()
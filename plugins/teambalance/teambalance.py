@@ -0,0 +1,315 @@
+# minqlbot - A Quake Live server administrator bot.
+# Copyright (C) 2015 Mino <mino@minomino.org>
+
+# This file is part of minqlbot.
+
+# minqlbot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# minqlbot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with minqlbot. If not, see <http://www.gnu.org/licenses/>.
+
+"""Balancing algorithms working on plain lists of ratings.
+
+Nothing in here knows about players, the rating cache or the server. The balance
+plugin turns teams into lists of ratings, lets these figure out what to do, and
+then turns the result back into players.
+
+"""
+
+import heapq
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Below this many candidate pairs, building the arrays costs more than it saves.
+NUMPY_MIN_PAIRS = 64
+
+class OutOfTime(Exception):
+    pass
+
+class SwapEvaluator():
+    """Keeps the rating sums of both teams and scores red/blue swaps from those.
+
+    Swapping red player i with blue player j changes the difference in average rating
+    by (red[i] - blue[j]) * (1/len(red) + 1/len(blue)), so every candidate can be scored
+    from the two ratings involved instead of recomputing both averages. To avoid any
+    floating point noise when comparing candidates, everything is scaled by
+    len(red) * len(blue) and kept as integers until the very end.
+
+    """
+    def __init__(self, red, blue):
+        self.red = list(red)
+        self.blue = list(blue)
+        self.red_sum = sum(self.red)
+        self.blue_sum = sum(self.blue)
+
+    def averages(self):
+        avg_red = self.red_sum / len(self.red) if self.red else 0
+        avg_blue = self.blue_sum / len(self.blue) if self.blue else 0
+        return avg_red, avg_blue
+
+    def difference(self):
+        avg_red, avg_blue = self.averages()
+        return abs(avg_red - avg_blue)
+
+    def best_swap(self):
+        """Find the swap that brings the averages closest together.
+
+        Returns a tuple (red_index, blue_index, improvement) where the improvement
+        is how much the difference in average rating goes down, or None if no swap
+        makes things better.
+
+        """
+        n_red = len(self.red)
+        n_blue = len(self.blue)
+        if not n_red or not n_blue:
+            return None
+
+        scale = n_red * n_blue
+        current = self.red_sum * n_blue - self.blue_sum * n_red
+        factor = n_red + n_blue
+
+        if numpy is not None and scale >= NUMPY_MIN_PAIRS:
+            delta = numpy.subtract.outer(numpy.array(self.red, dtype=numpy.float64),
+                                         numpy.array(self.blue, dtype=numpy.float64))
+            scores = numpy.abs(current - delta * factor)
+            i, j = numpy.unravel_index(int(numpy.argmin(scores)), scores.shape)
+            i, j = int(i), int(j)
+            best = float(scores[i, j])
+        else:
+            best = None
+            for red_i, red_rating in enumerate(self.red):
+                base = current - red_rating * factor
+                for blue_j, blue_rating in enumerate(self.blue):
+                    score = abs(base + blue_rating * factor)
+                    if best is None or score < best:
+                        best = score
+                        i, j = red_i, blue_j
+
+        if best < abs(current):
+            return (i, j, (abs(current) - best) / scale)
+        else:
+            return None
+
+    def win_probability(self):
+        """The Elo expected score of red against blue, from 0 to 1."""
+        avg_red, avg_blue = self.averages()
+        return win_probability(avg_red - avg_blue)
+
+    def top_swaps(self, k):
+        """Score every swap by red's chance of winning afterwards and get the k that come
+        closest to 50%, closest first. Swaps that don't make the teams more even than they
+        already are are left out, so there might be fewer than k.
+
+        Returns a list of (red_index, blue_index, probability) tuples.
+
+        """
+        n_red = len(self.red)
+        n_blue = len(self.blue)
+        if not n_red or not n_blue or k <= 0:
+            return []
+
+        scale = n_red * n_blue
+        current = self.red_sum * n_blue - self.blue_sum * n_red
+        factor = n_red + n_blue
+
+        if numpy is not None and scale >= NUMPY_MIN_PAIRS:
+            delta = numpy.subtract.outer(numpy.array(self.red, dtype=numpy.float64),
+                                         numpy.array(self.blue, dtype=numpy.float64)).ravel()
+            # The scaled difference in average rating after every swap, all at once.
+            diffs = current - delta * factor
+            better = numpy.flatnonzero(numpy.abs(diffs) < abs(current))
+            if not better.size:
+                return []
+            k = min(k, better.size)
+            best = better[numpy.argpartition(numpy.abs(diffs[better]), k - 1)[:k]]
+            best = best[numpy.argsort(numpy.abs(diffs[best]), kind="stable")]
+            probabilities = 1 / (1 + 10 ** (-diffs[best] / scale / 400))
+            return [(int(x) // n_blue, int(x) % n_blue, float(p)) for x, p in zip(best, probabilities)]
+        else:
+            diffs = ((i * n_blue + j, current - (red_rating - blue_rating) * factor)
+                     for i, red_rating in enumerate(self.red) for j, blue_rating in enumerate(self.blue))
+            better = (x for x in diffs if abs(x[1]) < abs(current))
+            best = heapq.nsmallest(k, better, key=lambda x: abs(x[1]))
+            return [(x // n_blue, x % n_blue, win_probability(d / scale)) for x, d in best]
+
+    def swap(self, i, j):
+        """Apply a swap, updating the sums in constant time."""
+        red_rating = self.red[i]
+        blue_rating = self.blue[j]
+        self.red[i] = blue_rating
+        self.blue[j] = red_rating
+        self.red_sum += blue_rating - red_rating
+        self.blue_sum += red_rating - blue_rating
+
+def win_probability(difference):
+    """The Elo expected score of a team whose average rating is higher by a difference."""
+    return 1 / (1 + 10 ** (-difference / 400))
+
+def greedy_split(red, blue):
+    """Even out the number of players on each team and keep applying the best single
+    swap until none of them helps.
+
+    Players are identified by their position in red + blue. Returns the set of
+    positions that end up on the red team.
+
+    """
+    ratings = list(red) + list(blue)
+    red_ids = list(range(len(red)))
+    blue_ids = list(range(len(red), len(ratings)))
+    # Move players off the end of the bigger team until the sizes are even.
+    while len(red_ids) - len(blue_ids) > 1:
+        blue_ids.append(red_ids.pop())
+    while len(blue_ids) - len(red_ids) > 1:
+        red_ids.append(blue_ids.pop())
+
+    evaluator = SwapEvaluator([ratings[i] for i in red_ids], [ratings[i] for i in blue_ids])
+    swap = evaluator.best_swap()
+    while swap:
+        i, j = swap[0], swap[1]
+        red_ids[i], blue_ids[j] = blue_ids[j], red_ids[i]
+        evaluator.swap(i, j)
+        swap = evaluator.best_swap()
+
+    return set(red_ids)
+
+def optimal_partition(ratings, budget=0.005):
+    """Split the ratings into two halves of equal size with sums as close as possible.
+
+    Branch and bound over the ratings sorted in descending order. At every node we know
+    the smallest and largest sum the remaining picks could possibly add, so whole subtrees
+    that can't beat the best split so far are skipped. With an even number of players, the
+    first one always goes in the chosen half, since the other half is just the mirror image.
+    With an odd number, the halves are different sizes, so there's no mirror to skip.
+
+    The search stops once the time budget in seconds runs out, in which case the best split
+    found so far is returned. Returns a tuple (indices, complete) where indices is the set of
+    positions in the half and complete tells whether the search was exhaustive.
+
+    """
+    n = len(ratings)
+    size = n // 2
+    if not size:
+        return set(), True
+
+    order = sorted(range(n), key=lambda i: ratings[i], reverse=True)
+    values = [ratings[i] for i in order]
+    total = sum(values)
+    prefix = [0]
+    for v in values:
+        prefix.append(prefix[-1] + v)
+
+    # Seed with a greedy split so pruning has something to work with from the start.
+    picked = []
+    other = 0
+    s = 0
+    for i, v in enumerate(values):
+        if len(picked) < size and (s <= other or i - len(picked) >= n - size):
+            picked.append(i)
+            s += v
+        else:
+            other += v
+    best = [abs(2 * s - total), picked]
+    # We can't do better than this, so stop as soon as we get there.
+    perfect = total % 2
+    deadline = time.perf_counter() + budget
+    nodes = [0]
+    chosen = []
+
+    def search(i, need, s):
+        nodes[0] += 1
+        if not nodes[0] & 0x3ff and time.perf_counter() > deadline:
+            raise OutOfTime()
+
+        if not need or n - i == need:
+            if need:
+                s += prefix[n] - prefix[i]
+            diff = abs(2 * s - total)
+            if diff < best[0]:
+                best[0] = diff
+                best[1] = chosen + list(range(i, n)) if need else chosen.copy()
+            return best[0] <= perfect
+
+        lowest = s + prefix[n] - prefix[n - need]
+        highest = s + prefix[i + need] - prefix[i]
+        if 2 * lowest - total >= best[0] or total - 2 * highest >= best[0]:
+            return False
+
+        chosen.append(i)
+        done = search(i + 1, need - 1, s + values[i])
+        chosen.pop()
+        if done:
+            return True
+        return search(i + 1, need, s)
+
+    complete = True
+    if best[0] > perfect:
+        try:
+            if n % 2:
+                search(0, size, 0)
+            else:
+                chosen.append(0)
+                search(1, size - 1, values[0])
+        except OutOfTime:
+            complete = False
+
+    return set(order[i] for i in best[1]), complete
+
+def optimal_split(red, blue, budget=0.005):
+    """Find the best split of the players with optimal_partition().
+
+    Players are identified by their position in red + blue. Returns the set of
+    positions that should be on the red team. If the teams are already even and the
+    search ran out of time before finding anything better, the current split is kept.
+
+    """
+    ratings = list(red) + list(blue)
+    total = sum(ratings)
+    half, complete = optimal_partition(ratings, budget)
+    if len(red) == len(blue) and abs(2 * sum(red) - total) <= abs(2 * sum(ratings[i] for i in half) - total):
+        return set(range(len(red)))
+
+    return half
+
+def plan_moves(n_red, n_blue, target_red):
+    """Work out the fewest commands that take the current teams to a target split.
+
+    Players are identified by their position in red + blue, with the first n_red
+    being on the red team. A switch moves one player each way and a put moves a single
+    player, so pairing up as many as possible and putting the rest is optimal. If both
+    teams are the same size in the target split, its mirror image is just as balanced,
+    so we go with whichever of the two needs fewer moves.
+
+    Returns a list of ("switch", red_position, blue_position) and
+    ("put", position, team) tuples.
+
+    """
+    total = n_red + n_blue
+    target = set(target_red)
+
+    def moving(target):
+        to_blue = [i for i in range(n_red) if i not in target]
+        to_red = [i for i in range(n_red, total) if i in target]
+        return to_blue, to_red
+
+    to_blue, to_red = moving(target)
+    if len(target) * 2 == total:
+        mirror_blue, mirror_red = moving(set(range(total)) - target)
+        if max(len(mirror_blue), len(mirror_red)) < max(len(to_blue), len(to_red)):
+            to_blue, to_red = mirror_blue, mirror_red
+
+    moves = [("switch", i, j) for i, j in zip(to_blue, to_red)]
+    moves += [("put", i, "blue") for i in to_blue[len(to_red):]]
+    moves += [("put", j, "red") for j in to_red[len(to_blue):]]
+    return moves
@@ -0,0 +1 @@
+from plugins.teamstate.teamstate import TeamState, tracker, track
@@ -0,0 +1,137 @@
+# minqlbot - A Quake Live server administrator bot.
+# Copyright (C) 2015 Mino <mino@minomino.org>
+
+# This file is part of minqlbot.
+
+# minqlbot is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# minqlbot is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with minqlbot. If not, see <http://www.gnu.org/licenses/>.
+
+"""Who's on which team, kept up to date from hooks instead of asking for it every time.
+
+Plugins that want to use it call track() when they're loaded, which makes the plugin's
+player_connect, player_disconnect, team_switch and bot_connect hooks update the shared
+tracker before any of the plugin's own handlers run. Updates just set where a player is,
+so it doesn't matter how many plugins pass on the same event.
+
+"""
+
+import collections
+import minqlbot
+import threading
+
+TEAMS = ("red", "blue", "spectator", "free")
+
+class TeamState():
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.synced = False
+        # Keys: clean name in lowercase - Items: [Player, team]
+        self.players = collections.OrderedDict()
+        self.sizes = dict.fromkeys(TEAMS, 0)
+
+    def sync(self, teams):
+        """Start over from a dict of teams like the one minqlbot.Plugin.teams() returns.
+
+        """
+        with self.lock:
+            self.players.clear()
+            self.sizes = dict.fromkeys(TEAMS, 0)
+            for team in TEAMS:
+                for player in teams.get(team, ()):
+                    self.players[player.clean_name.lower()] = [player, team]
+                    self.sizes[team] += 1
+            self.synced = True
+
+    def connect(self, player):
+        with self.lock:
+            name = player.clean_name.lower()
+            if name not in self.players:
+                # Players reconnecting after a map change go straight back on their team.
+                team = player.team if player.team in TEAMS else "spectator"
+                self.players[name] = [player, team]
+                self.sizes[team] += 1
+
+    def disconnect(self, player):
+        with self.lock:
+            name = player.clean_name.lower()
+            if name in self.players:
+                self.move(name, None)
+                del self.players[name]
+
+    def switch(self, player, new_team):
+        with self.lock:
+            name = player.clean_name.lower()
+            if name not in self.players:
+                self.players[name] = [player, "spectator"]
+                self.sizes["spectator"] += 1
+            else:
+                self.players[name][0] = player
+            self.move(name, new_team)
+
+    def move(self, name, new_team):
+        """Move a player and update the team sizes.
+
+        """
+        old_team = self.players[name][1]
+        if old_team == new_team:
+            return
+        self.players[name][1] = new_team
+        if old_team in self.sizes:
+            self.sizes[old_team] -= 1
+        if new_team in self.sizes:
+            self.sizes[new_team] += 1
+
+    def teams(self, plugin=None):
+        """Get a dict of teams like the one minqlbot.Plugin.teams() returns. If we haven't
+        been synced yet, the plugin passed is used to do so first.
+
+        """
+        with self.lock:
+            if not self.synced and plugin:
+                self.sync(plugin.teams())
+            res = {team: [] for team in TEAMS}
+            for player, team in self.players.values():
+                res[team].append(player)
+            return res
+
+    def all_players(self, plugin=None):
+        """Get everyone on the server, like minqlbot.Plugin.players() does.
+
+        """
+        with self.lock:
+            if not self.synced and plugin:
+                self.sync(plugin.teams())
+            return [player for player, team in self.players.values()]
+
+    def count(self, *teams, plugin=None):
+        """Get how many players are on the teams passed. Like teams(), the plugin passed
+        is used to sync first if we haven't been synced yet.
+
+        """
+        with self.lock:
+            if not self.synced and plugin:
+                self.sync(plugin.teams())
+            return sum(self.sizes[team] for team in teams)
+
+tracker = TeamState()
+
+def track(plugin):
+    """Keep the tracker up to date with the events a plugin gets.
+
+    """
+    plugin.add_hook("player_connect", tracker.connect, priority=minqlbot.PRI_HIGHEST)
+    plugin.add_hook("player_disconnect", lambda player, reason: tracker.disconnect(player),
+                    priority=minqlbot.PRI_HIGHEST)
+    plugin.add_hook("team_switch", lambda player, old_team, new_team: tracker.switch(player, new_team),
+                    priority=minqlbot.PRI_HIGHEST)
+    plugin.add_hook("bot_connect", lambda: tracker.sync(plugin.teams()), priority=minqlbot.PRI_HIGHEST)